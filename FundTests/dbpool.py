@@ -0,0 +1,205 @@
+import os
+import datetime
+import sqlite3
+import threading
+import pyodbc
+
+DBNAME = 'OracleDB' #DSN for ODBC
+PWD = 'pmanikonda_99'
+ORACLESTRING = 'DSN=%s;PWD=%s' % (DBNAME, PWD) #default connection string, see configure
+MAXIDLE = 4 #idle connections kept per connection string
+DatabaseError = (pyodbc.Error, sqlite3.Error) #errors raised by either kind of connection
+
+def oraclestring(dbname=DBNAME, pwd=PWD):
+    """Builds an ODBC connection string."""
+    return 'DSN=%s;PWD=%s' % (dbname, pwd)
+
+class Row(tuple):
+    """sqlite row that also allows the pyodbc style row.COLUMN access."""
+    def __new__(cls, cursor, values):
+        row = tuple.__new__(cls, values)
+        row.columns = [description[0].upper() for description in cursor.description]
+        return row
+
+    def __getattr__(self, name):
+        try:
+            return self[self.columns.index(name.upper())]
+        except ValueError:
+            raise AttributeError(name)
+
+def convertdate(value):
+    """
+    Reads a sqlite DATE column as a datetime, like an Oracle DATE through pyodbc.
+    The columns hold whole timestamps, which sqlite's own DATE converter rejects.
+    """
+    value = value.replace('T',' ')
+    if len(value)<=10:
+        return datetime.datetime.strptime(value,'%Y-%m-%d')
+    stamp = datetime.datetime.strptime(value[:19],'%Y-%m-%d %H:%M:%S')
+    if len(value)>20 and value[19]=='.':
+        stamp = stamp.replace(microsecond=int(value[20:26].ljust(6,'0')))
+    return stamp
+
+sqlite3.register_converter('DATE', convertdate) #used by the connections of sqliteconnector
+
+def sqliteconnector(filename):
+    """
+    Returns a connector for a local sqlite database, to stand in for Oracle when testing:
+    configure(connector=sqliteconnector('test.db')).
+    """
+    def connector():
+        cnxn = sqlite3.connect(filename, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        cnxn.row_factory = Row
+        return cnxn
+    return connector
+
+class ConnectionPool:
+    def __init__(self, connector, maxidle=MAXIDLE):
+        """
+        Constructor for class to keep database connections open for reuse.
+
+        Parameters
+        ----------
+        connector : function
+            called with no arguments to open a new connection
+        maxidle : int (default MAXIDLE)
+            number of released connections kept open
+        """
+        self.connector = connector
+        self.maxidle = maxidle
+        self.idle = []
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.opened, self.reused = 0, 0
+
+    def acquire(self):
+        """Returns an idle connection, or opens a new one."""
+        with self.lock:
+            if self.pid!=os.getpid():
+                #a forked worker must not share its parent's connections
+                self.idle, self.pid = [], os.getpid()
+            if self.idle:
+                self.reused += 1
+                return self.idle.pop()
+            self.opened += 1
+        return self.connector()
+
+    def release(self, cnxn):
+        """Rolls back anything uncommitted, like a close would, and keeps the connection for reuse."""
+        try:
+            cnxn.rollback()
+        except DatabaseError:
+            cnxn.close() #broken connection, don't reuse it
+            return
+        with self.lock:
+            if len(self.idle)<self.maxidle and self.pid==os.getpid():
+                self.idle.append(cnxn)
+                return
+        cnxn.close()
+
+    def closeall(self):
+        """Closes the idle connections."""
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for cnxn in idle:
+            cnxn.close()
+
+class PooledConnection:
+    def __init__(self, pool):
+        """Connection taken from a pool; close() hands it back instead of closing it."""
+        self.pool = pool
+        self.cnxn = pool.acquire()
+
+    def cursor(self):
+        return self.cnxn.cursor()
+
+    def commit(self):
+        self.cnxn.commit()
+
+    def rollback(self):
+        self.cnxn.rollback()
+
+    def close(self):
+        if self.cnxn is not None:
+            self.pool.release(self.cnxn)
+            self.cnxn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excinfo):
+        self.close()
+
+POOLS = {} #one pool per connection string
+SETTINGS = {'connectstring' : ORACLESTRING, 'connector' : None}
+NAMED = {} #pool name : (connection string, connector), see register
+POOLSLOCK = threading.Lock()
+
+def configure(connectstring=None, connector=None, maxidle=MAXIDLE):
+    """
+    Sets the default database used by every module.
+
+    Parameters
+    ----------
+    connectstring : string (default None)
+        ODBC connection string; if None, keep the current one
+    connector : function (default None)
+        opens a connection when called with no arguments, e.g. sqliteconnector;
+        if None, pyodbc.connect(connectstring) is used
+    maxidle : int (default MAXIDLE)
+        idle connections kept per connection string
+    """
+    closeall()
+    if connectstring is not None:
+        SETTINGS['connectstring'] = connectstring
+    SETTINGS['connector'] = connector
+    SETTINGS['maxidle'] = maxidle
+
+def register(name, connectstring, connector=None):
+    """
+    Names a database that isn't the configured default, so modules with their own
+    credentials can connect with connect(name).
+
+    Parameters
+    ----------
+    name : string
+        name passed to connect in place of a connection string
+    connectstring : string
+        ODBC connection string
+    connector : function (default None)
+        opens a connection when called with no arguments, e.g. sqliteconnector;
+        if None, pyodbc.connect(connectstring) is used
+    """
+    with POOLSLOCK:
+        previous = POOLS.pop(name,None)
+        NAMED[name] = (connectstring, connector)
+    if previous:
+        previous.closeall()
+
+def getpool(connectstring=None):
+    """Returns the pool for a connection string or registered name (the configured default if None)."""
+    usedefault = connectstring is None or connectstring==SETTINGS['connectstring']
+    connectstring = SETTINGS['connectstring'] if connectstring is None else connectstring
+    with POOLSLOCK:
+        if not(connectstring in POOLS):
+            if connectstring in NAMED:
+                realstring, connector = NAMED[connectstring]
+                connector = connector if connector else (lambda : pyodbc.connect(realstring))
+            elif usedefault and SETTINGS['connector']:
+                connector = SETTINGS['connector']
+            else:
+                connector = lambda : pyodbc.connect(connectstring)
+            POOLS[connectstring] = ConnectionPool(connector, SETTINGS.get('maxidle',MAXIDLE))
+        return POOLS[connectstring]
+
+def connect(connectstring=None):
+    """Drop-in for pyodbc.connect that reuses pooled connections (the configured default if None, see also register)."""
+    return PooledConnection(getpool(connectstring))
+
+def closeall():
+    """Closes every idle pooled connection."""
+    with POOLSLOCK:
+        pools = POOLS.values()
+        POOLS.clear()
+    for pool in pools:
+        pool.closeall()
@@ -0,0 +1,140 @@
+import os
+import json
+import threading
+import xlrd
+from multiprocessing.pool import ThreadPool
+
+SHOCKDIR = '\\\\anpdnas1\\chp_prod$\\Trading\\Model\\' #root of the dated shock workbook folders
+SHEETNAME = 'VAHA_Output' #sheet holding the up and down shock results
+CACHEFILE = 'c:\\temp\\deltacache.json' #persistent deltas, see DeltaCache
+
+def shockworkbook(deltadate):
+    """Returns the filename of the shock workbook for deltadate."""
+    shocklocation = SHOCKDIR+str(deltadate.year)+'\\'+deltadate.strftime('%Y%m')+'\\'+deltadate.strftime('%Y%m%d')+'\\'
+    files = os.listdir(shocklocation)
+    return shocklocation+filter(lambda x: x[-3:]=='xls', files)[0]
+
+def spxshockdelta(filename):
+    """Reads the unscaled SPX delta (half the down minus up shock) out of a shock workbook."""
+    wb = xlrd.open_workbook(filename,on_demand=True) #only the shock sheet is parsed
+    sht = wb.sheet_by_name(SHEETNAME)
+    startval = 2 if sht.cell_value(0,1)=='CSA' else 1
+    upshock = sum(sht.row_values(2,startval,startval+6))
+    downshock = sum(sht.row_values(3,startval,startval+6))
+    wb.release_resources()
+    return -(upshock-downshock)/2.0
+
+class DeltaCache:
+    def __init__(self, filename=CACHEFILE):
+        """
+        Constructor for class to keep deltas on local disk between runs.
+        Entries are keyed by date and remember the workbook and its modification
+        time, so a delta is recalculated when its workbook is replaced.
+
+        Parameters
+        ----------
+        filename : string (default CACHEFILE)
+            JSON file holding the deltas
+        """
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.entries = json.load(open(filename)) if os.path.exists(filename) else {}
+
+    def get(self, deltadate, workbook, mtime):
+        """Returns the stored delta for deltadate, or None if it is missing or its workbook changed."""
+        entry = self.entries.get(deltadate.strftime('%Y%m%d'))
+        if entry and entry[0]==workbook and entry[1]==mtime:
+            return entry[2]
+        return None
+
+    def put(self, deltadate, workbook, mtime, delta, save=True):
+        with self.lock:
+            self.entries[deltadate.strftime('%Y%m%d')] = [workbook,mtime,delta]
+        if save:
+            self.save()
+
+    def save(self):
+        with self.lock:
+            directory = os.path.dirname(self.filename)
+            if directory and not(os.path.isdir(directory)):
+                os.makedirs(directory)
+            tempname = '%s.%d.tmp' % (self.filename,os.getpid()) #worker processes may save at the same time
+            f = open(tempname,'w')
+            json.dump(self.entries,f)
+            f.close()
+            try:
+                if os.path.exists(self.filename):
+                    os.remove(self.filename)
+                os.rename(tempname,self.filename)
+            except OSError:
+                os.remove(tempname) #another process replaced it first, its deltas do as well
+
+def getdelta(deltadate, spxpct, cache=None, save=True):
+    """
+    Calculates the delta for a 1% shock to the account value as of deltadate.
+
+    Parameters
+    ----------
+    deltadate : datetime
+        date of the shock workbook
+    spxpct : function
+        returns the SPX share of account value for a date, to scale the delta
+    cache : DeltaCache (default None)
+        if given, the delta is read from it while its workbook is unchanged,
+        and stored in it otherwise
+    save : bool (default True)
+        if False, a new delta is stored without rewriting the cache file
+    """
+    workbook = shockworkbook(deltadate)
+    if cache:
+        mtime = os.path.getmtime(workbook)
+        delta = cache.get(deltadate,workbook,mtime)
+        if delta is not None:
+            return delta
+    delta = spxshockdelta(workbook)/spxpct(deltadate)
+    if cache:
+        cache.put(deltadate,workbook,mtime,delta,save)
+    return delta
+
+def prefetch(dates, spxpct, cache=None, workers=8):
+    """
+    Calculates the deltas of many dates at once, reading the workbooks
+    in a thread pool so their network I/O overlaps.
+
+    Parameters
+    ----------
+    dates : list of datetimes
+    spxpct : function
+        see getdelta
+    cache : DeltaCache (default None)
+        see getdelta; the cache file is written once at the end
+    workers : int (default 8)
+        number of threads
+
+    Returns
+    -------
+    deltas : dict
+        date : delta of the dates that succeeded
+    failures : list
+        (date, error message) tuples of the dates that failed
+    """
+    def job(deltadate):
+        try:
+            return deltadate, getdelta(deltadate,spxpct,cache,save=False), None
+        except Exception as e:
+            return deltadate, None, repr(e)
+    pool = ThreadPool(max(1,min(workers,len(dates))))
+    try:
+        outputs = pool.map(job,sorted(set(dates)))
+    finally:
+        pool.close()
+        pool.join()
+    if cache:
+        cache.save()
+    deltas, failures = {}, []
+    for deltadate, delta, error in outputs:
+        if error:
+            failures.append((deltadate,error))
+        else:
+            deltas[deltadate] = delta
+    return deltas, failures
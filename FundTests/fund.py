@@ -1,22 +1,30 @@
 import scipy
-import os
 import pylab
 import datetime
 import streams
+import pfuvparser
+import navcache
+import deltacache
 import scipy.optimize
-import xlrd
-import pyodbc
+import scipy.linalg
+import dbpool
+import itertools
+import multiprocessing
+import time
+import lrucache
 
-DELTACACHE = {} #initialization of cache for cachedelta function
-AVCACHE = {} #initialization of cache for avcache function
+LRUCache = lrucache.LRUCache #shared with streams, see lrucache
+DELTACACHE = LRUCache(64) #initialization of cache for cachedelta function
+FUNDAVCACHE = LRUCache(64) #per-date tables of fund AVs, see fundavs
+DELTASTORE = {} #'cache' : deltacache.DeltaCache kept between runs by cachedelta, see deltastore
 FILENAME = 'H:\dat\PFUVFILE.TXT' #location of fund data file
-ORACLESTRING = streams.ORACLESTRING
+ORACLESTRING = dbpool.ORACLESTRING #alias of the dbpool default at import
 
 def calcspxpct(evaldate):
     """
     Calculates the percentage of account value allocated to SPX as of evaldate.
     """
-    cnxn = pyodbc.connect(ORACLESTRING)
+    cnxn = dbpool.connect()
     c = cnxn.cursor()
     sql = "SELECT Sum(CASH) as BILL, Sum(BOND) as BND, Sum(SMALL_CAP) as RTY, Sum(LARGE_CAP) as SPX, "
     sql += "Sum(INTERNATIONAL) as EAFE, Sum(FIXED) as FXD, Sum(DCA_PLUS) as DCA FROM ODSACT.ACT_RSL_SERIATIM WHERE "
@@ -26,27 +34,44 @@ def calcspxpct(evaldate):
     cnxn.close()
     return row.SPX / (row.BILL + row.BND + row.RTY + row.SPX+row.EAFE+row.FXD+row.DCA)
 
-def getdelta(deltadate):
+def getdelta(deltadate, cache=None):
     """
     Calculates the delta for a 1% shock to the account value as of deltadate.
+    If a deltacache.DeltaCache is given, the delta is kept in it between runs.
     """
-    shocklocation = '\\\\anpdnas1\\chp_prod$\\Trading\Model\\'+str(deltadate.year)+'\\'+deltadate.strftime('%Y%m')+'\\'+deltadate.strftime('%Y%m%d')+'\\'
-    files = os.listdir(shocklocation)
-    filename = filter(lambda x: x[-3:]=='xls', files)[0]
-    wb = xlrd.open_workbook(shocklocation+filename)
-    sht = wb.sheet_by_name('VAHA_Output')
-    startval = 2 if sht.cell(0,1).value=='CSA' else 1
-    upshock = sum([sht.cell(2,i).value for i in range(startval,startval+6)])
-    downshock = sum([sht.cell(3,i).value for i in range(startval,startval+6)])
-    spxdelta = -(upshock-downshock)/2.0
-    scalefactor = calcspxpct(deltadate)
-    return spxdelta/scalefactor
+    return deltacache.getdelta(deltadate,calcspxpct,cache)
+
+def setdeltastore(cache):
+    """Sets the deltacache.DeltaCache that cachedelta reads and fills; None turns it off."""
+    DELTASTORE['cache'] = cache
+
+def deltastore():
+    """Returns the deltacache.DeltaCache of cachedelta, opening deltacache.CACHEFILE on first use."""
+    if not('cache' in DELTASTORE):
+        DELTASTORE['cache'] = deltacache.DeltaCache()
+    return DELTASTORE['cache']
+
+def prefetchdeltas(dates, cache=None, workers=8):
+    """
+    Calculates the deltas of many dates concurrently (see deltacache.prefetch)
+    and puts them in DELTACACHE for cachedelta. If cache is None, deltastore() is used.
+    
+    Returns
+    -------
+    failures : list
+        (date, error message) tuples of the dates that failed
+    """
+    deltas, failures = deltacache.prefetch(dates,calcspxpct,cache if cache else deltastore(),workers)
+    for deltadate, delta in deltas.items():
+        DELTACACHE.put(deltadate,delta)
+    return failures
 
 def oracledatebuilder(mydate):
     """Converts a Python datetime to an Oracle date string."""
     return "TO_DATE('"+mydate.strftime('%Y%m%d')+"','yyyymmdd')"
 
-def importdata(filename=FILENAME,dbstring=ORACLESTRING,baseonly=True):
+def importdata(filename=FILENAME,dbstring=None,baseonly=True,batchsize=5000,progress=False,
+               incremental=False,lookback=7):
     """
     Imports fund data into the Oracle database.
     
@@ -54,64 +79,308 @@ def importdata(filename=FILENAME,dbstring=ORACLESTRING,baseonly=True):
     ----------
     filename : string (default FILENAME)
         filename of text file to parse 
-    dbstring : string (default ORACLESTRING)
-        ODBC connection string for database
+    dbstring : string (default None)
+        ODBC connection string for database; if None, the dbpool default
     baseonly : bool (default True)
         if True, only import the base NAV,
         and the NAV for the PNDY mnemonic;
-        otherwise, import all records (slow)
+        otherwise, import all records
+    batchsize : int (default 5000)
+        number of rows sent per executemany
+    progress : bool (default False)
+        if True, print the row count and throughput after each batch
+    incremental : bool (default False)
+        if True, keep the existing data and only import NAVs newer than
+        the high-water mark of their company/mnemonic in funddatamarks;
+        otherwise, delete and reload everything
+    lookback : int (default 7)
+        in incremental mode, the last lookback days before each mark
+        are replaced too, so that corrected NAVs are picked up
+    
+    Returns
+    -------
+    count : int
+        number of rows imported
+    
+    Note
+    ----
+    The file is decoded in bulk by pfuvparser, filtering on the mnemonic
+    before the fund blocks are expanded, and rows are inserted with
+    parameterized batches. Every run records the new high-water marks.
     """
-    conn = pyodbc.connect(dbstring)
+    conn = dbpool.connect(dbstring)
     c = conn.cursor()
-    c.execute('delete from funddata;')
-    f = open(filename)
-    row = f.readline()
-    while row:
-        if row[0]=='U':
-            company = int(row[1:4])
-            mnemonic = row[4:12].strip()
-            if mnemonic == '': mnemonic='BASENAV'
-            date = datetime.datetime(int(row[12:16]),int(row[16:18]),int(row[18:20]))
-            date = oracledatebuilder(date)
-            fundcount = int(row[20:23])
-            for i in range(0,fundcount):
-                fundnum = int(row[23+i*12:23+i*12+3])
-                nav=int(row[26+i*12:26+i*12+9])/1000000.0
-                sql = "INSERT INTO funddata VALUES(%s, '%s', %s, %s, %s);" % (str(company), mnemonic, date, str(fundnum),str(nav))
-                if baseonly and (mnemonic=='BASENAV' or mnemonic=='PNDY'):
-                	c.execute(sql)
-                elif not(baseonly):
-					c.execute(sql)
-        row = f.readline()
+    try:
+        c.fast_executemany = True #pyodbc 4.0.19+ sends each batch as one array
+    except AttributeError:
+        pass
+    try:
+        c.execute('CREATE TABLE funddatamarks (company NUMBER, mnemonic VARCHAR2(8), navdate DATE);')
+    except dbpool.DatabaseError:
+        pass    #already there
+    mnemonics = ['BASENAV','PNDY'] if baseonly else None
+    watermarks, newmarks = {}, {}
+    if incremental:
+        c.execute('SELECT company, mnemonic, navdate FROM funddatamarks;')
+        for row in c.fetchall():
+            newmarks[(int(row[0]),row[1].strip())] = row[2] #marks of mnemonics this run skips are kept as they are
+        watermarks = dict((key,mark) for key, mark in newmarks.items() if mnemonics is None or key[1] in mnemonics)
+        #replace the lookback window of the imported mnemonics, which also clears rows left by an interrupted run
+        c.executemany('DELETE FROM funddata WHERE company=? AND mnemonic=? AND navdate>?;',
+                      [(company,mnemonic,mark-datetime.timedelta(days=lookback)) for (company,mnemonic), mark in watermarks.items()])
+    else:
+        c.execute('delete from funddata;')
+    sql = 'INSERT INTO funddata VALUES(?, ?, ?, ?, ?);'
+    count, started = 0, time.time()
+    for records in pfuvparser.iterchunks(filename,mnemonics=mnemonics,basename='BASENAV'):
+        if incremental:
+            records = pfuvparser.afterwatermark(records,watermarks,lookback)
+        pfuvparser.updatewatermarks(records,newmarks)
+        rows = pfuvparser.torows(records)
+        for i in range(0,len(rows),batchsize):
+            batch = rows[i:i+batchsize]
+            c.executemany(sql,batch)
+            count += len(batch)
+            if progress:
+                print '%d rows imported, %.0f rows/s' % (count, count/max(time.time()-started,1E-9))
+    c.execute('DELETE FROM funddatamarks;')
+    if newmarks:
+        c.executemany('INSERT INTO funddatamarks VALUES(?, ?, ?);',
+                      [(company,mnemonic,mark) for (company,mnemonic), mark in newmarks.items()])
     conn.commit()
     conn.close()
+    if progress:
+        print '%d rows imported in %.1fs' % (count, time.time()-started)
+    return count
 
 def cachedelta(date):
-    """Cached wrapper for getdelta."""
-    if date in DELTACACHE.keys():
-		return DELTACACHE[date]
-    else:
-        DELTACACHE[date] = getdelta(date)
-        return DELTACACHE[date]
+    """Cached wrapper for getdelta; the deltas are also kept between runs in deltastore()."""
+    return DELTACACHE.get(date,lambda mydate : getdelta(mydate,deltastore()))
+
+def loadfundavs(funddate):
+    """Queries the AV of every fund as of funddate with one query; returns a dict of fund number : AV."""
+    cnxn = dbpool.connect()
+    cursor = cnxn.cursor()
+    sql = "SELECT FUND_NO, Sum(Fund_Val) AS FundTotal FROM ODSACT.ACT_PRC_CONTRACT_FUND_VALUE WHERE GENERATION_DATE="
+    sql += oracledatebuilder(funddate) + " AND GENERATION_TYPE='W' GROUP BY FUND_NO;"
+    cursor.execute(sql)
+    avs = {}
+    for row in cursor.fetchall():
+        if row[1] is not None:
+            fundno = str(row[0]).strip()
+            avs[int(fundno) if fundno.isdigit() else fundno] = float(row[1])
+    cnxn.close()
+    return avs
+
+def loadfundavtables(funddates, chunksize=1000):
+    """
+    Queries the AV of every fund as of each of funddates, with one query per chunksize
+    dates (Oracle's limit on an IN list); returns a dict of date : (fund number : AV).
+    """
+    tables = dict((funddate,{}) for funddate in funddates)
+    byday = {}
+    for funddate in tables:
+        byday.setdefault(funddate.strftime('%Y%m%d'),[]).append(funddate)
+    days = sorted(byday.keys())
+    cnxn = dbpool.connect()
+    cursor = cnxn.cursor()
+    for i in range(0,len(days),chunksize):
+        sql = "SELECT GENERATION_DATE, FUND_NO, Sum(Fund_Val) AS FundTotal FROM ODSACT.ACT_PRC_CONTRACT_FUND_VALUE WHERE GENERATION_DATE IN ("
+        sql += ','.join([oracledatebuilder(byday[day][0]) for day in days[i:i+chunksize]])
+        sql += ") AND GENERATION_TYPE='W' GROUP BY GENERATION_DATE, FUND_NO;"
+        cursor.execute(sql)
+        for row in cursor.fetchall():
+            if row[2] is not None:
+                fundno = str(row[1]).strip()
+                for funddate in byday.get(row[0].strftime('%Y%m%d'),[]):
+                    tables[funddate][int(fundno) if fundno.isdigit() else fundno] = float(row[2])
+    cnxn.close()
+    return tables
+
+def fundavs(funddate):
+    """Cached table of the AV of every fund as of funddate, shared by all funds."""
+    return FUNDAVCACHE.get(funddate,loadfundavs)
+
+def fundavtables(funddates):
+    """
+    Tables of the AV of every fund as of each of funddates (see fundavs); the dates
+    that aren't in FUNDAVCACHE are loaded together by loadfundavtables.
+    Returns a dict of date : (fund number : AV).
+    """
+    funddates = set(funddates)
+    tables = dict((funddate,fundavs(funddate)) for funddate in funddates if funddate in FUNDAVCACHE)
+    missing = [funddate for funddate in funddates if not(funddate in tables)]
+    if missing:
+        tables.update(loadfundavtables(missing))
+    return tables
 
 def avcache(funddate):
     """Cached function to get the total AV as of funddate"""
-    if funddate in AVCACHE.keys():
-		return AVCACHE[funddate]
+    return sum(fundavs(funddate).values())
+
+def simplexlsq(gram, cross, guess=None, maxiter=100):
+    """
+    Solves the least squares problem min |X*beta - y|^2 with the weights
+    in beta between 0 and 1 and summing to 1, using a primal active-set method
+    on the precomputed Gram matrix.
+    
+    Parameters
+    ----------
+    gram : 2-d array
+        X'X for the index return matrix X
+    cross : 1-d array
+        X'y for the fund returns y
+    guess : 1-d array (default None)
+        feasible starting weights, e.g. the previous solution;
+        if None, everything starts in the first index
+    maxiter : int (default 100)
+        maximum number of active-set changes
+    
+    Returns
+    -------
+    beta : 1-d array
+        the optimal weights
+    """
+    size = cross.size
+    if guess is None:
+        beta = scipy.zeros(size)
+        beta[0] = 1.0
     else:
-        cnxn = pyodbc.connect(ORACLESTRING)
-        cursor = cnxn.cursor()
-        sql = "SELECT Sum(Fund_Val) AS FundTotal FROM ODSACT.ACT_PRC_CONTRACT_FUND_VALUE WHERE GENERATION_DATE="
-        sql += oracledatebuilder(funddate) + " AND GENERATION_TYPE='W';"
-        cursor.execute(sql)
-        row = cursor.fetchone()
-        AVCACHE[funddate] = float(row[0])
+        beta = scipy.clip(scipy.asarray(guess,dtype=float).flatten(),0.0,1.0)
+        beta = beta/beta.sum() if beta.sum()>0 else scipy.ones(size)/size
+    tol = 1E-12*max(scipy.absolute(scipy.diag(gram)).max(),1E-300)
+    free = beta>0.0
+    for iteration in range(0,maxiter):
+        #minimize over the free weights subject only to the sum constraint
+        freeindex = scipy.flatnonzero(free)
+        kkt = scipy.zeros((freeindex.size+1,freeindex.size+1))
+        kkt[:-1,:-1] = gram[scipy.ix_(freeindex,freeindex)]
+        kkt[:-1,-1] = 1.0
+        kkt[-1,:-1] = 1.0
+        solution = scipy.linalg.lstsq(kkt,scipy.append(cross[freeindex],1.0))[0]
+        step = scipy.zeros(size)
+        step[freeindex] = solution[:-1]-beta[freeindex]
+        if scipy.absolute(step).max()<=1E-15:
+            #at the optimum of the free set, check the multipliers of the zero weights
+            multipliers = scipy.dot(gram,beta)-cross+solution[-1]
+            multipliers[free] = 0.0
+            release = scipy.argmin(multipliers)
+            if multipliers[release]>=-tol:
+                break
+            free[release] = True
+        else:
+            blocking = scipy.flatnonzero((step<0.0) & free)
+            ratios = -beta[blocking]/step[blocking]
+            alpha = min(1.0,ratios.min()) if blocking.size else 1.0
+            beta = beta+alpha*step
+            if alpha<1.0:
+                stop = blocking[scipy.argmin(ratios)]
+                beta[stop] = 0.0
+                free[stop] = False
+    beta = scipy.clip(beta,0.0,1.0)
+    return beta/beta.sum()
+
+def mappingfromrow(row):
+    """Converts a row of ODSACT.ACT_SRC_FUND_MAPPING into a mapping dict."""
+    return {'TBILL' : float(row.CASH),
+            'AGG'   : float(row.BOND),
+            'RTY'   : float(row.SMALL_CAP),
+            'SPX'   : float(row.LARGE_CAP),
+            'EAFE'  : float(row.INTERNATIONAL)}
+
+def loadmapping(fundcode, asofdate=datetime.datetime.now()):
+    """Queries the fund's mapping as of asofdate; returns None if there is none."""
+    conn = dbpool.connect()
+    c = conn.cursor()
+    sql = 'SELECT * FROM ODSACT.ACT_SRC_FUND_MAPPING WHERE FUND_NO='+str(fundcode)+';'
+    c.execute(sql)
+    mapping = None
+    for row in c.fetchall():
+        if asofdate<row.END_DATE and asofdate>=row.START_DATE:
+            mapping = mappingfromrow(row)
+    conn.close()
+    return mapping
+
+class FundUniverse:
+    def __init__(self, companies=[101], mnemonics=['BASENAV','PNDY'], fundnums=None,
+                 tablename='funddata', loadmappings=True, dbstring=None, arraysize=10000):
+        """
+        Constructor for class to hold the NAVs of many funds, loaded with one ordered scan
+        of the fund table and split into per-fund arrays, so that Funds and AdjFunds can be
+        built without going back to the database.
+        
+        Parameters
+        ----------
+        companies : list of ints (default [101])
+            companies to load
+        mnemonics : list of strings (default ['BASENAV','PNDY'])
+            product codes to load
+        fundnums : list of ints (default None)
+            if None, all funds are loaded
+        tablename : string (default 'funddata')
+            table holding the NAVs
+        loadmappings : bool (default True)
+            if True, also load the fund mappings with one query
+        dbstring : string (default None)
+            ODBC connection string for database; if None, the dbpool default
+        arraysize : int (default 10000)
+            number of rows fetched per round trip
+        """
+        cnxn = dbpool.connect(dbstring)
+        c = cnxn.cursor()
+        c.arraysize = arraysize
+        sql = 'SELECT company, mnemonic, fundnum, navdate, nav FROM %s WHERE company IN (%s) AND mnemonic IN (%s)' \
+              % (tablename, ','.join(['?']*len(companies)), ','.join(['?']*len(mnemonics)))
+        params = list(companies)+list(mnemonics)
+        if fundnums:
+            sql += ' AND fundnum IN (%s)' % ','.join(['?']*len(fundnums))
+            params += list(fundnums)
+        c.execute(sql+' ORDER BY company, mnemonic, fundnum, navdate;', params)
+        keys, dates, navs = [], [], []
+        rows = c.fetchmany(arraysize)
+        while rows:
+            keys.extend([(int(row[0]),row[1].strip(),int(row[2])) for row in rows])
+            dates.extend([row[3] for row in rows])
+            navs.extend([row[4] for row in rows])
+            rows = c.fetchmany(arraysize)
+        navs = scipy.asarray(navs,dtype=float)
+        #rows are ordered by fund, so each fund is one contiguous block
+        self.navdata = {}
+        start = 0
+        for i in range(1,len(keys)+1):
+            if i==len(keys) or keys[i]!=keys[start]:
+                self.navdata[keys[start]] = (dates[start:i],navs[start:i])
+                start = i
+        self.mappings = {}
+        if loadmappings:
+            sql = 'SELECT * FROM ODSACT.ACT_SRC_FUND_MAPPING'
+            if fundnums:
+                sql += ' WHERE FUND_NO IN (%s)' % ','.join([str(fundnum) for fundnum in fundnums])
+            c.execute(sql+';')
+            for row in c.fetchall():
+                #plain tuples, so the universe pickles to worker processes without driver rows
+                self.mappings.setdefault(int(row.FUND_NO),[]).append((row.START_DATE,row.END_DATE,mappingfromrow(row)))
         cnxn.close()
-        return AVCACHE[funddate]
+    
+    def funds(self):
+        """Returns the (company, mnemonic, fundnum) keys that were loaded."""
+        return sorted(self.navdata.keys())
+    
+    def navs(self, company, mnemonic, fundcode):
+        """Returns the NAV dates (list) and NAVs (1-d array) of a fund, both empty if it wasn't loaded."""
+        return self.navdata.get((company,mnemonic,fundcode),([],scipy.zeros(0)))
+    
+    def mapping(self, fundcode, asofdate=datetime.datetime.now()):
+        """Returns the fund's mapping as of asofdate, or None if there is none."""
+        mapping = None
+        for start, end, rowmapping in self.mappings.get(fundcode,[]):
+            if asofdate<end and asofdate>=start:
+                mapping = dict(rowmapping)
+        return mapping
 
 class Fund:
     def __init__(self, company, mnemonic, fundcode, mapping=None,
-                 freq='D', forcedates=True, asofdate=datetime.datetime.now()):
+                 freq='D', forcedates=True, asofdate=datetime.datetime.now(), universe=None, cache=None):
         """
         Constructor for fund class.
         
@@ -135,36 +404,41 @@ class Fund:
             that a return is reported on a weekly/monthly basis.
         asofdate : datetime (default now())
             as of date for mappings
+        universe : FundUniverse (default None)
+            if given, the NAVs and mapping are taken from
+            this preloaded data instead of the database.
+        cache : navcache.NAVCache (default None)
+            if given (and universe isn't), the NAVs are read from
+            this local cache, and stored in it if they are missing;
+            call cache.flush() once a batch of funds is loaded.
         """
-        conn = pyodbc.connect(ORACLESTRING)
-        c = conn.cursor()
-        sql = "SELECT * from funddata WHERE company=%s and mnemonic='%s' and fundnum=%s ORDER BY navdate;" % (str(company),mnemonic,str(fundcode))
-        c.execute(sql)
-        rows = c.fetchall()
-        dates = [row[2] for row in rows]
-        navs = [row[4] for row in rows]
-        self.stream = streams.BasicStream(dates,scipy.asarray(navs))
+        if universe:
+            dates, navs = universe.navs(company,mnemonic,fundcode)
+        elif cache:
+            dates, navs = cache.fetch(navcache.fundkey(company,mnemonic,fundcode),
+                                      lambda : self.getNAVInfofromdb('funddata',mnemonic,None,company,fundcode))
+        else:
+            conn = dbpool.connect()
+            c = conn.cursor()
+            sql = "SELECT * from funddata WHERE company=%s and mnemonic='%s' and fundnum=%s ORDER BY navdate;" % (str(company),mnemonic,str(fundcode))
+            c.execute(sql)
+            rows = c.fetchall()
+            dates = [row[2] for row in rows]
+            navs = [row[4] for row in rows]
+            conn.close()
+        self.stream = streams.BasicStream(dates,scipy.asarray(navs),flat=True)
         if freq!='D': self.stream = self.stream.changefreq(freq,forcedates=forcedates)
         self.freq = freq
         if mapping:
             self.mapping = mapping
+        elif universe:
+            self.mapping = universe.mapping(fundcode,asofdate)
         else:
-            sql = 'SELECT * FROM ODSACT.ACT_SRC_FUND_MAPPING WHERE FUND_NO='+str(fundcode)+';'
-            c.execute(sql)
-            for row in c.fetchall():
-                if asofdate<row.END_DATE and asofdate>=row.START_DATE:
-                    self.mapping = {'TBILL' : float(row.CASH),
-                                    'AGG'   : float(row.BOND),
-                                    'RTY'   : float(row.SMALL_CAP),
-                                    'SPX'   : float(row.LARGE_CAP),
-                                    'EAFE'  : float(row.INTERNATIONAL)}
-        if not('mapping' in dir(self)):
-            self.mapping = None
+            self.mapping = loadmapping(fundcode,asofdate)
         self.company = company
         self.mnemonic = mnemonic
         self.fundcode = fundcode
         self.plot = self.stream.plot
-        conn.close()
 
     def backtest(self, trainstart, trainend, backteststart, backtestend, mktbasket):
         """
@@ -190,11 +464,58 @@ class Fund:
         self.regress(trainstart,trainend,mktbasket)
         return self.stats(backteststart,backtestend,mktbasket) 
     
+    def walkforward(self, schedule, mktbasket):
+        """
+        Runs a walk-forward backtest over a schedule of train/test splits.
+        The fund is aligned once over the whole schedule, and every split
+        is regressed and tested on slices of the aligned returns,
+        warm-starting each regression from the previous split's weights.
+        
+        Parameters
+        ----------
+        schedule : list of tuples
+            (trainstart, trainend, backteststart, backtestend)
+            datetimes for each split, as in backtest
+        mktbasket : dict or streams.MarketPanel
+            dictionary of market streams
+        
+        Returns
+        -------
+        list with one dictionary of statistics per split, as returned by stats,
+        or None for a split with fewer than 3 returns to train or test on
+        
+        Side Effects
+        ---- -------
+        Like backtest, leaves the mapping of the last regressed split in the class.
+        """
+        spanstart = min([split[0] for split in schedule]+[split[2] for split in schedule])
+        spanend = max([split[1] for split in schedule]+[split[3] for split in schedule])
+        if not(isinstance(mktbasket, streams.MarketPanel)):
+            mktbasket = streams.MarketPanel(mktbasket)
+        hits, getdates = mktbasket.aligndates(self.stream, spanstart, spanend)
+        if hits is None:
+            return [None for split in schedule]
+        inputmatrix, indexes = mktbasket.rows(hits), mktbasket.keys()
+        fundreturns = self.stream.datereturns(getdates).returns.flatten()
+        beta, results = None, []
+        for trainstart, trainend, backteststart, backtestend in schedule:
+            train = mktbasket.subwindow(hits, trainstart, trainend)
+            test = mktbasket.subwindow(hits, backteststart, backtestend)
+            if train.stop-train.start<3 or test.stop-test.start<3:
+                results.append(None)
+                continue
+            gram = scipy.dot(inputmatrix[train].T,inputmatrix[train])
+            cross = scipy.dot(inputmatrix[train].T,fundreturns[train])
+            beta = simplexlsq(gram,cross,beta)
+            self.mapping = dict(zip(indexes,beta))
+            results.append(self.periodstats(inputmatrix[test],fundreturns[test],indexes,self.mapping,backteststart))
+        return results
+    
     def getNAVInfofromdb(self,tablename,mnemonicstring,oraclestring,company,fundcode):
         sql = ("SELECT * from %s WHERE company=%s and mnemonic='%s' and fundnum=%s ORDER BY navdate;") \
                                                                    % (tablename,str(company),mnemonicstring,str(fundcode))
        
-        conn = pyodbc.connect(oraclestring)
+        conn = dbpool.connect(oraclestring)
         c = conn.cursor()
         c.execute(sql)
         column_names = [row[0] for row in c.description]
@@ -209,6 +530,7 @@ class Fund:
             datesbase.extend([row[navdateindex] for row in rows])
             navsbase.extend([row[navindex] for row in rows])        #4 was append prior
             rows = c.fetchmany(100)
+        conn.close()
         return datesbase,navsbase
    
     def plotreturns(self):
@@ -216,24 +538,14 @@ class Fund:
         pylab.plot(self.stream.enddates,scipy.cumprod(1.0+self.stream.returns))
     
     def av(self, date):
-        """Returns the fund's AV for a given date."""
-        cnxn = pyodbc.connect(ORACLESTRING)
-        cursor = cnxn.cursor()
-        sql = "SELECT Sum(Fund_Val) AS FundTotal FROM ODSACT.ACT_PRC_CONTRACT_FUND_VALUE WHERE GENERATION_DATE="
-        sql += oracledatebuilder(date) + " AND GENERATION_TYPE='W' AND FUND_NO='"+str(self.fundcode) + "';"
-        cursor.execute(sql)
-        row = cursor.fetchone()
-        cnxn.close()
-        if row[0]:
-            return float(row[0])
-        else:
-            return 0.0
+        """Returns the fund's AV for a given date (0.0 if it has none), see fundavs."""
+        return fundavs(date).get(int(self.fundcode),0.0)
 
     def deltaestimate(self, date):
         """Estimates the fund's delta on a date."""
         return cachedelta(date)*self.av(date)/avcache(date)
 
-    def align(self,startdate,enddate,mktbasket):
+    def align(self,startdate,enddate,mktbasket,alldates=False):
         """
         Aligns the funds returns with the market returns
         to ensure that there are the same number of returns
@@ -245,8 +557,11 @@ class Fund:
             beginning of alignment period
         enddate : datetime
             end of alignment period
-        mktbasket : dict
-            dictionary of market streams
+        mktbasket : dict or streams.MarketPanel
+            dictionary of market streams, or a panel
+            built from it once and shared by all funds
+        alldates : bool (default False)
+            if True, daterange holds every aligned date
         
         Returns
         -------
@@ -259,27 +574,34 @@ class Fund:
             a list of the indexes in inputmatrix
         daterange : list
             beginning and end dates of the aligned
-            data
+            data (all of the aligned dates if alldates)
         
         Note
         ----
         Will return None, None, None, None if
         no data is available between startdate and enddate.
         """
+        if isinstance(mktbasket, streams.MarketPanel):
+            getdates, fundreturns, inputmatrix = mktbasket.align(self.stream, startdate, enddate)
+            if getdates is None:
+                return None, None, None, None
+            daterange = getdates if alldates else [getdates[0], getdates[-1]]
+            return inputmatrix, fundreturns.reshape(fundreturns.size,1), mktbasket.keys(), daterange
         hybridstream,indexes = [],[]
         for index in mktbasket.keys():
             hybridstream.append(mktbasket[index][startdate:enddate])
             indexes.append(index)
         getdates = self.stream.overlap(hybridstream)
         if not(getdates) or len(getdates)<3:
-            return None, None, None, None        daterange = [getdates[0], getdates[-1]]
+            return None, None, None, None
+        daterange = getdates if alldates else [getdates[0], getdates[-1]]
         fundreturns = self.stream.datereturns(getdates).returns
         indexreturns = [indexstream.datereturns(getdates).returns for indexstream in hybridstream]
         inputmatrix = scipy.vstack(indexreturns).T
         fundreturns = fundreturns.reshape(fundreturns.size,1)
         return inputmatrix, fundreturns, indexes, daterange
 
-    def regress(self, startdate, enddate, mktbasket):
+    def regress(self, startdate, enddate, mktbasket, method='activeset'):
         """
         Regresses a fund against the market indices.
         
@@ -291,6 +613,10 @@ class Fund:
             end of regression period
         mktbasket : dict
             dictionary of market streams
+        method : string (default 'activeset')
+            'activeset' solves on the Gram matrix with simplexlsq,
+            'slsqp' minimizes the SSE with scipy.optimize.fmin_slsqp
+            (slower, kept to validate the active-set results)
         
         Returns
         -------
@@ -304,16 +630,139 @@ class Fund:
         inputmatrix, fundreturns, indexes, daterange = self.align(startdate, enddate, mktbasket)
         if inputmatrix is None:
             self.mapping = None
-            return None        def SSE(beta):
-            return scipy.sum((scipy.dot(inputmatrix,beta.reshape(len(indexes),1))-fundreturns)**2.0)
-        sumconstraint = lambda beta : 1.0-sum(beta)        guess = scipy.asarray([1.0] + [0.0] * (len(indexes)-1))
-        bounds = [(0.0,1.0) for i in range(0,len(indexes))]
-        finalbeta = scipy.optimize.fmin_slsqp(SSE,guess,eqcons=[sumconstraint],bounds=bounds,iprint=0,acc=1E-20)
+            return None
+        guess = scipy.asarray([1.0] + [0.0] * (len(indexes)-1))
+        if method=='slsqp':
+            def SSE(beta):
+                return scipy.sum((scipy.dot(inputmatrix,beta.reshape(len(indexes),1))-fundreturns)**2.0)
+            sumconstraint = lambda beta : 1.0-sum(beta)
+            bounds = [(0.0,1.0) for i in range(0,len(indexes))]
+            finalbeta = scipy.optimize.fmin_slsqp(SSE,guess,eqcons=[sumconstraint],bounds=bounds,iprint=0,acc=1E-20)
+        elif method=='activeset':
+            gram = scipy.dot(inputmatrix.T,inputmatrix)
+            cross = scipy.dot(inputmatrix.T,fundreturns).flatten()
+            finalbeta = simplexlsq(gram,cross,guess)
+        else:
+            raise ValueError("unknown regression method '%s'" % method)
         self.mapping = {}
         for i in range(0,len(indexes)):
             self.mapping[indexes[i]] = finalbeta[i]
         return self.mapping
 
+    def rollingregress(self, startdate, enddate, window, mktbasket, step=1):
+        """
+        Regresses the fund over a sliding window of returns.
+        The fund is aligned once over the whole period, and X'X, X'y and y'y
+        are updated as returns enter and leave the window. Each solve is
+        warm-started from the previous window's weights.
+        
+        Parameters
+        ----------
+        startdate : datetime
+            beginning of the whole period
+        enddate : datetime
+            end of the whole period
+        window : int
+            number of aligned returns in each regression
+        mktbasket : dict or streams.MarketPanel
+            dictionary of market streams
+        step : int (default 1)
+            number of returns the window moves between regressions
+        
+        Returns
+        -------
+        windowends : list of datetimes
+            last date of each window
+        mappings : 2-d array
+            one row of weights per window, one column per index
+        fitstats : dict of 1-d arrays
+            'SSE', 'TE' and 'R2' of each window, with TE and R2
+            defined as in Fund.stats
+        indexes : list
+            the indexes in the columns of mappings
+        
+        Note
+        ----
+        Will return None, None, None, None if fewer than window
+        returns are available between startdate and enddate.
+        Unlike regress, the fund's mapping is left untouched.
+        """
+        inputmatrix, fundreturns, indexes, getdates = self.align(startdate, enddate, mktbasket, alldates=True)
+        if inputmatrix is None or fundreturns.size<window:
+            return None, None, None, None
+        fundreturns = fundreturns.flatten()
+        ends = range(window,fundreturns.size+1,step)
+        mappings = scipy.zeros((len(ends),len(indexes)))
+        fitstats = dict((name,scipy.zeros(len(ends))) for name in ['SSE','TE','R2'])
+        gram = scipy.dot(inputmatrix[:window].T,inputmatrix[:window])
+        cross = scipy.dot(inputmatrix[:window].T,fundreturns[:window])
+        sumx, sumy = inputmatrix[:window].sum(axis=0), fundreturns[:window].sum()
+        sumyy = scipy.dot(fundreturns[:window],fundreturns[:window])
+        beta = None
+        for i in range(0,len(ends)):
+            end = ends[i]
+            if i>0:
+                entering, leaving = slice(ends[i-1],end), slice(ends[i-1]-window,end-window)
+                gram += scipy.dot(inputmatrix[entering].T,inputmatrix[entering])-scipy.dot(inputmatrix[leaving].T,inputmatrix[leaving])
+                cross += scipy.dot(inputmatrix[entering].T,fundreturns[entering])-scipy.dot(inputmatrix[leaving].T,fundreturns[leaving])
+                sumx += inputmatrix[entering].sum(axis=0)-inputmatrix[leaving].sum(axis=0)
+                sumy += fundreturns[entering].sum()-fundreturns[leaving].sum()
+                sumyy += scipy.dot(fundreturns[entering],fundreturns[entering])-scipy.dot(fundreturns[leaving],fundreturns[leaving])
+            beta = simplexlsq(gram,cross,beta)
+            mappings[i] = beta
+            #moments of the projected and actual returns from the sufficient statistics
+            sumpp, sumpy, sump = scipy.dot(beta,scipy.dot(gram,beta)), scipy.dot(beta,cross), scipy.dot(beta,sumx)
+            sse = max(sumyy-2.0*sumpy+sumpp,0.0)
+            meandiff = (sumy-sump)/window
+            varp, vary = sumpp/window-(sump/window)**2.0, sumyy/window-(sumy/window)**2.0
+            covpy = sumpy/window-(sump/window)*(sumy/window)
+            fitstats['SSE'][i] = sse
+            fitstats['TE'][i] = scipy.sqrt(max(sse/window-meandiff**2.0,0.0))*100.0*100.0
+            fitstats['R2'][i] = covpy**2.0/(varp*vary) if varp>0.0 and vary>0.0 else 0.0
+        windowends = [getdates[end-1] for end in ends]
+        return windowends, mappings, fitstats, indexes
+
+    def periodstats(self, inputmatrix, fundreturns, indexes, mapping, startdate):
+        """
+        Calculates the statistics of Fund.stats on aligned returns.
+        
+        Parameters
+        ----------
+        inputmatrix : 2-d array
+            aligned index returns, see align
+        fundreturns : array
+            aligned fund returns
+        indexes : list
+            the indexes in inputmatrix
+        mapping : dict
+            weights of the indexes
+        startdate : datetime
+            date of the AV and delta
+        
+        Returns
+        -------
+        stats : dict
+            dictionary of statistics
+        """
+        weights = scipy.array([mapping[mykey] if mykey in mapping else 0.0 for mykey in indexes])
+        projected = scipy.dot(inputmatrix,weights.reshape(len(indexes),1)).flatten()
+        actual = fundreturns.flatten()
+        diff = actual-projected
+        outdata = {
+                 'TE'     : scipy.std(diff)*100.0*100.0,
+                 'BETA'   : scipy.cov(projected,actual)[1,0]/scipy.var(projected),
+                 'ALPHA'  : (scipy.product(diff+1.0))**(1.0/diff.size)-1.0,
+                 'VOL'    : scipy.std(actual)*scipy.sqrt(252.0),
+                 'PROJ'   : scipy.product(1.0+projected)-1.0,
+                 'ACT'    : scipy.product(1.0+actual)-1.0,
+                 'R2'     : 0.0 if scipy.all(actual==0.0) else scipy.corrcoef(projected,actual)[1,0]**2.0,
+                 'AV'     : self.av(startdate),
+                 'DELTA'  : self.deltaestimate(startdate)
+                }
+        outdata['DIFF'] = outdata['ACT']-outdata['PROJ']
+        outdata['PL'] = outdata['DELTA']*outdata['DIFF']*100.0
+        return outdata
+
     def stats(self, startdate, enddate, mktbasket, output = False):
         """
         Calculates statistics for a fund over a period.
@@ -336,25 +785,9 @@ class Fund:
         """
         inputmatrix, fundreturns, indexes, daterange = self.align(startdate, enddate, mktbasket)
         if self.mapping and not(inputmatrix is None):
-            weights = scipy.array([self.mapping[mykey] if mykey in self.mapping else 0.0 for mykey in mktbasket.keys()])
-            projected = scipy.dot(inputmatrix,weights.reshape(len(indexes),1)).flatten()
-            actual = fundreturns.flatten()
-            diff = actual-projected
-            outdata = {
-                     'TE'     : scipy.std(diff)*100.0*100.0,
-                     'BETA'   : scipy.cov(projected,actual)[1,0]/scipy.var(projected),
-                     'ALPHA'  : (scipy.product(diff+1.0))**(1.0/diff.size)-1.0,
-                     'VOL'    : scipy.std(actual)*scipy.sqrt(252.0),
-                     'PROJ'   : scipy.product(1.0+projected)-1.0,
-                     'ACT'    : scipy.product(1.0+actual)-1.0,
-                     'R2'     : 0.0 if scipy.all(actual==0.0) else scipy.corrcoef(projected,actual)[1,0]**2.0,
-                     'AV'     : self.av(startdate),
-                     'DELTA'  : self.deltaestimate(startdate)
-                    }
-            outdata['DIFF'] = outdata['ACT']-outdata['PROJ']
-            outdata['PL'] = outdata['DELTA']*outdata['DIFF']*100.0 
+            outdata = self.periodstats(inputmatrix, fundreturns, indexes, self.mapping, startdate)
             if output:
-                cnxn = pyodbc.connect(ORACLESTRING)
+                cnxn = dbpool.connect()
                 cursor = cnxn.cursor()
                 sql = 'INSERT INTO FUNDOUTPUT VALUES ({0!s},{1!s},{2!s},{3!s},{4!s},{5!s},{6},{7},{8!s},{9!s},{10!s},{11!s},{12!s},{13!s});'
                 sql = sql.format(self.fundcode,outdata['PROJ'],outdata['ACT'],outdata['DIFF'],
@@ -368,6 +801,110 @@ class Fund:
         else:
             return None
     
+    def rollingstats(self, startdate, enddate, window, mktbasket, step=1, withpl=True, deltas=None, avs=None, cache=None):
+        """
+        Calculates the statistics of Fund.stats for a sliding window of returns.
+        The fund is aligned once over the whole period, and every window's
+        statistics come from prefix sums of the projected and actual returns
+        (and of their logs, for the compounded returns).
+        
+        Parameters
+        ----------
+        startdate : datetime
+            beginning of the whole period
+        enddate : datetime
+            end of the whole period
+        window : int
+            number of aligned returns in each window
+        mktbasket : dict or streams.MarketPanel
+            dictionary of market streams
+        step : int (default 1)
+            number of returns the window moves between windows
+        withpl : bool (default True)
+            if True, the AV, DELTA and PL of each window are calculated;
+            otherwise they are nan
+        deltas : dict (default None)
+            date : delta of cachedelta, e.g. shared by every fund of a run;
+            the window starts it lacks are taken from DELTACACHE, or read
+            concurrently by deltacache.prefetch
+        avs : dict (default None)
+            date : table of fund AVs, see fundavtables; the window starts
+            it lacks are loaded with one query
+        cache : deltacache.DeltaCache (default None)
+            passed on to deltacache.prefetch; if None, deltastore() is used
+        
+        Returns
+        -------
+        windowstarts : list of datetimes
+            date of the AV and delta of each window: the date of the
+            return before the window, or startdate for the first return
+        windowends : list of datetimes
+            last date of each window
+        stats : dict of 1-d arrays
+            the statistics of Fund.stats, one entry per window;
+            DELTA and PL are nan where the delta couldn't be calculated
+        
+        Note
+        ----
+        Will return None, None, None if the fund has no mapping
+        or fewer than window returns are available.
+        """
+        inputmatrix, fundreturns, indexes, getdates = self.align(startdate, enddate, mktbasket, alldates=True)
+        if not(self.mapping) or inputmatrix is None or fundreturns.size<window:
+            return None, None, None
+        weights = scipy.array([self.mapping[mykey] if mykey in self.mapping else 0.0 for mykey in indexes])
+        projected = scipy.dot(inputmatrix,weights)
+        actual = fundreturns.flatten()
+        starts = scipy.arange(0,actual.size-window+1,step)
+        ends = starts+window
+        prefix = lambda values : scipy.concatenate(([0.0],scipy.cumsum(values)))
+        windowsum = lambda values : (lambda sums : sums[ends]-sums[starts])(prefix(values))
+        #second moments of the centered returns, which keeps the differences of the sums accurate
+        p, a = projected-projected.mean(), actual-actual.mean()
+        n = float(window)
+        sump, suma = windowsum(p), windowsum(a)
+        sumpp, sumaa, sumpa = windowsum(p*p), windowsum(a*a), windowsum(p*a)
+        varp, vara = sumpp/n-(sump/n)**2.0, sumaa/n-(suma/n)**2.0
+        covpa = sumpa/n-(sump/n)*(suma/n)
+        vard = scipy.maximum(vara+varp-2.0*covpa,0.0)
+        stats = {}
+        with scipy.errstate(divide='ignore',invalid='ignore'):
+            stats['TE'] = scipy.sqrt(vard)*100.0*100.0
+            stats['BETA'] = covpa*n/(n-1.0)/varp #sample covariance over population variance, as in stats
+            stats['ALPHA'] = scipy.exp(windowsum(scipy.log(actual-projected+1.0))/n)-1.0
+            stats['VOL'] = scipy.sqrt(scipy.maximum(vara,0.0))*scipy.sqrt(252.0)
+            stats['PROJ'] = scipy.exp(windowsum(scipy.log1p(projected)))-1.0
+            stats['ACT'] = scipy.exp(windowsum(scipy.log1p(actual)))-1.0
+            stats['R2'] = scipy.where(windowsum(actual!=0.0)==0.0,0.0,covpa**2.0/(varp*vara))
+        stats['DIFF'] = stats['ACT']-stats['PROJ']
+        windowstarts = [getdates[start-1] if start>0 else startdate for start in starts]
+        windowends = [getdates[end-1] for end in ends]
+        stats['AV'], stats['DELTA'] = scipy.zeros(starts.size)*scipy.nan, scipy.zeros(starts.size)*scipy.nan
+        if withpl:
+            dates = sorted(set(windowstarts))
+            deltas = dict(deltas) if deltas else {} #used directly, DELTACACHE may hold fewer dates
+            for mydate in dates:
+                if not(mydate in deltas) and mydate in DELTACACHE:
+                    deltas[mydate] = DELTACACHE.get(mydate,getdelta)
+            missing = [mydate for mydate in dates if not(mydate in deltas)]
+            if missing:
+                shocks = deltacache.prefetch(missing,calcspxpct,cache if cache else deltastore())[0]
+                for mydate, delta in shocks.items():
+                    DELTACACHE.put(mydate,delta)
+                deltas.update(shocks)
+            avs = dict(avs) if avs else {}
+            avs.update(fundavtables([mydate for mydate in dates if not(mydate in avs)]))
+            fundav, funddelta = {}, {}
+            for mydate in dates:
+                fundav[mydate] = avs[mydate].get(int(self.fundcode),0.0)
+                total = sum(avs[mydate].values())
+                if mydate in deltas and total>0.0:
+                    funddelta[mydate] = deltas[mydate]*fundav[mydate]/total
+            stats['AV'] = scipy.array([fundav[mydate] for mydate in windowstarts])
+            stats['DELTA'] = scipy.array([funddelta.get(mydate,scipy.nan) for mydate in windowstarts])
+        stats['PL'] = stats['DELTA']*stats['DIFF']*100.0
+        return windowstarts, windowends, stats
+
     def error(self,startdate,enddate,threshold=0.03):
         """
         Checks for possible erroneous returns.
@@ -390,18 +927,12 @@ class Fund:
             a list of (date,return) tuples
             that exceed the threshold
         """
-        dt,errs,err = startdate, [], False
-        while dt<=enddate:
-            ret = self.stream[dt]
-            if ret:
-                if abs(ret)>threshold:
-                    err = True
-                    errs.append((dt,ret))
-            dt+=datetime.timedelta(days=1)
-        return err, errs
+        errs = [(dt,ret) for i, dt, ret in errorscan([self.stream],startdate,enddate,threshold)]
+        return len(errs)>0, errs
             
 class AdjFund(Fund):
-    def __init__(self,fundcode,company=101,mapping=None,freq='D',forcedates=True,asofdate=datetime.datetime.now()):
+    def __init__(self,fundcode,company=101,mapping=None,freq='D',forcedates=True,asofdate=datetime.datetime.now(),universe=None,cache=None,
+                 mnemonics=['BASENAV','PNDY'],rule='max'):
         """
         Constructor for fund class.
         
@@ -422,45 +953,267 @@ class AdjFund(Fund):
             that a return is reported on a weekly/monthly basis.
         asofdate : datetime (default now())
             as of date for mappings
+        universe : FundUniverse (default None)
+            if given, the NAVs and mapping are taken from
+            this preloaded data instead of the database.
+        cache : navcache.NAVCache (default None)
+            if given (and universe isn't), the NAVs are read from
+            this local cache, and stored in it if they are missing.
+        mnemonics : list of strings (default ['BASENAV','PNDY'])
+            NAV sources of the fund, in priority order
+        rule : string (default 'max')
+            how the return of each date is picked among the sources,
+            see streams.hybridsources
         
         Note
         ----
         Only difference for this is that it replaces bad returns from the basenavs
-        with the NAVs from PNDY.  This is admittedly a hack, and I need to think of
-        a better solution in the future.
+        with the returns of the other sources (PNDY by default). The source picked on
+        each daily date (before any change of freq) is kept in winners, as an index
+        into mnemonics.
         """
-        mnemonics = ['BASENAV','PNDY']
         FundDBTable = 'tdees.funddata'
-        datesbase,navsbase = self.getNAVInfofromdb(FundDBTable,mnemonics[0],ORACLESTRING,company,fundcode)
-        datespndy,navspndy = self.getNAVInfofromdb(FundDBTable,mnemonics[1],ORACLESTRING,company,fundcode)
-        self.stream = streams.hybridstream(datesbase,datespndy,scipy.array(navsbase),scipy.array(navspndy))
+        keys = [navcache.fundkey(company,mnemonic,fundcode) for mnemonic in mnemonics]
+        if not(universe) and cache and all([cache.valid(key) for key in keys]):
+            navdata = [cache.get(key) for key in keys]
+        else:
+            if not(universe):
+                #one scan for both mnemonics and the mapping of this fund
+                universe = FundUniverse([company],mnemonics,[fundcode],tablename=FundDBTable,loadmappings=not(mapping))
+                if cache:
+                    for mnemonic, key in zip(mnemonics,keys):
+                        cache.put(key,*universe.navs(company,mnemonic,fundcode))
+                    cache.flush()
+            navdata = [universe.navs(company,mnemonic,fundcode) for mnemonic in mnemonics]
+        self.stream, self.winners = streams.hybridsources(navdata,rule)
+        self.sources = list(mnemonics)
         if freq!='D': self.stream = self.stream.changefreq(freq,forcedates=forcedates)
         self.freq = freq
         if mapping:
             self.mapping = mapping
+        elif universe:
+            self.mapping = universe.mapping(fundcode,asofdate)
         else:
-            sql = 'SELECT * FROM ODSACT.ACT_SRC_FUND_MAPPING WHERE FUND_NO='+str(fundcode)+';'
-            c.execute(sql)
-            for row in c.fetchall():
-                if asofdate<row.END_DATE and asofdate>=row.START_DATE:
-                    self.mapping = {'TBILL' : float(row.CASH),
-                                    'AGG'   : float(row.BOND),
-                                    'RTY'   : float(row.SMALL_CAP),
-                                    'SPX'   : float(row.LARGE_CAP),
-                                    'EAFE'  : float(row.INTERNATIONAL)}
-        if not('mapping' in dir(self)):
-            self.mapping = None
+            self.mapping = loadmapping(fundcode,asofdate)
         self.company = company
         self.mnemonic = 'ADJ'
         self.fundcode = fundcode
         self.plot = self.stream.plot
-        conn.close()
 
         
 #these are the funds that aren't available for PNDY.  See the AdjFund Note for more detail.
 basefunds = [825,826,827,850,851,852,853,875,876,877,878,879,880,881,884,885,886,887,888,923,995]
         
-def graballandoutput(startdate,enddate,mktbasket,asofdate=datetime.datetime.now()):
+def regressall(funds, startdate, enddate, mktbasket):
+    """
+    Regresses a list of funds against the market indices in one batch.
+    Funds that align on the same dates share one market matrix and Gram matrix,
+    and their constrained regressions are solved against it together.
+    
+    Parameters
+    ----------
+    funds : list of Funds
+        funds to regress
+    startdate : datetime
+        beginning of regression period
+    enddate : datetime
+        end of regression period
+    mktbasket : dict or streams.MarketPanel
+        dictionary of market streams
+    
+    Returns
+    -------
+    mappings : 2-d array
+        one row per fund and one column per index;
+        the row is nan if the fund has no data in the period
+    indexes : list
+        the indexes in the columns of mappings
+    
+    Side Effects
+    ---- -------
+    Also pushes each mapping into its fund, like Fund.regress.
+    """
+    if not(isinstance(mktbasket, streams.MarketPanel)):
+        mktbasket = streams.MarketPanel(mktbasket)
+    indexes = mktbasket.keys()
+    mappings = scipy.zeros((len(funds),len(indexes)))*scipy.nan
+    groups = {}
+    for i in range(0,len(funds)):
+        hits, getdates = mktbasket.aligndates(funds[i].stream, startdate, enddate)
+        funds[i].mapping = None
+        if hits is not None:
+            group = groups.setdefault(hits.tostring(), (hits, getdates, []))
+            group[2].append(i)
+    guess = scipy.asarray([1.0] + [0.0] * (len(indexes)-1))
+    for hits, getdates, members in groups.values():
+        inputmatrix = mktbasket.rows(hits)
+        gram = scipy.dot(inputmatrix.T,inputmatrix)
+        fundmatrix = scipy.vstack([funds[i].stream.datereturns(getdates).returns.flatten() for i in members]).T
+        crosses = scipy.dot(inputmatrix.T,fundmatrix)
+        for j in range(0,len(members)):
+            mappings[members[j]] = simplexlsq(gram,crosses[:,j],guess)
+            funds[members[j]].mapping = dict(zip(indexes,mappings[members[j]]))
+    return mappings, indexes
+
+def errorscan(streamlist, startdate, enddate, threshold=0.03, zscore=None):
+    """
+    Checks many return streams for possible erroneous returns at once.
+    The returns of every stream on the days from startdate to enddate
+    (like Fund.error, the end dates a whole number of days after startdate)
+    are laid out on one shared date axis, and the rules are applied to the
+    whole matrix with boolean masks.
+    
+    Parameters
+    ----------
+    streamlist : list of ReturnStreams
+        streams to check
+    startdate : datetime
+        beginning of check period
+    enddate : datetime
+        end of check period
+    threshold : float or 1-d array (default 0.03)
+        a return is flagged if its absolute value exceeds the threshold;
+        an array gives one threshold per stream
+    zscore : float (default None)
+        if given, a return is also flagged if it is more than zscore
+        standard deviations away from its stream's mean return in the period
+    
+    Returns
+    -------
+    errs : list
+        (position in streamlist, date, return) tuples of the flagged returns,
+        in date order within each stream
+    """
+    start, end = scipy.datetime64(startdate,'us'), scipy.datetime64(enddate,'us')
+    picked = []
+    for stream in streamlist:
+        axis = stream.endaxis
+        first = scipy.zeros(axis.size,dtype=bool)
+        first[scipy.unique(axis,return_index=True)[1]] = True #the first return of a repeated date, like stream[dt]
+        offsets = (axis-start).astype(scipy.int64)
+        keep = first & (offsets>=0) & (axis<=end) & (offsets%86400000000==0)
+        picked.append((axis[keep],scipy.asarray(stream.returns,dtype=float).flatten()[keep]))
+    if not(picked):
+        return []
+    dateaxis = scipy.unique(scipy.concatenate([dates for dates, returns in picked]))
+    returns = scipy.zeros((len(picked),dateaxis.size))*scipy.nan
+    for i in range(0,len(picked)):
+        returns[i,scipy.searchsorted(dateaxis,picked[i][0])] = picked[i][1]
+    present = ~scipy.isnan(returns)
+    filled = scipy.where(present,returns,0.0)
+    thresholds = scipy.asarray(threshold,dtype=float).reshape(-1,1)
+    flags = present & (filled!=0.0) & (scipy.absolute(filled)>thresholds)
+    if zscore is not None:
+        counts = scipy.maximum(present.sum(axis=1),1).reshape(-1,1)
+        means = filled.sum(axis=1).reshape(-1,1)/counts
+        stds = scipy.sqrt((scipy.where(present,filled-means,0.0)**2.0).sum(axis=1).reshape(-1,1)/counts)
+        flags |= present & (stds>0.0) & (scipy.absolute(filled-means)>zscore*stds)
+    rows, columns = scipy.nonzero(flags)
+    dates = dateaxis[columns].tolist()
+    return zip(rows.tolist(),dates,returns[rows,columns].tolist())
+
+WORKERSTATE = {} #shared inputs of the fund jobs, set once in each worker process by initworker
+
+def initworker(state):
+    """
+    Stores the shared inputs (period, market basket, ...) for the fund jobs of a worker process.
+    Fund AV tables prefetched under 'fundavs' (date : table) are put in FUNDAVCACHE,
+    and deltas prefetched under 'deltas' (date : delta) in DELTACACHE.
+    """
+    WORKERSTATE.update(state)
+    for funddate, avs in state.get('fundavs',{}).items():
+        FUNDAVCACHE.put(funddate,avs)
+    for deltadate, delta in state.get('deltas',{}).items():
+        DELTACACHE.put(deltadate,delta)
+
+def batchuniverses(loadmappings=True):
+    """
+    Loads the NAVs of every fund for the batch reports: the AdjFunds' from
+    tdees.funddata and the basefunds' from funddata, as they read them alone.
+    
+    Returns
+    -------
+    universe : FundUniverse
+    baseuniverse : FundUniverse
+    """
+    universe = FundUniverse(tablename='tdees.funddata',loadmappings=loadmappings)
+    baseuniverse = FundUniverse(mnemonics=['BASENAV'],fundnums=basefunds,tablename='funddata',loadmappings=loadmappings)
+    return universe, baseuniverse
+
+def loadfund(fundnum, asofdate=datetime.datetime.now(), universe=None, baseuniverse=None):
+    """
+    Builds the Fund or AdjFund used for a fund number in the batch reports,
+    from baseuniverse or universe (see batchuniverses) when given.
+    """
+    if fundnum in basefunds:
+        return Fund(101,'BASENAV',fundnum,asofdate=asofdate,universe=baseuniverse)
+    else:
+        return AdjFund(fundnum,asofdate=asofdate,universe=universe) #changed it out, obviously
+
+def statsjob(fundnum):
+    """Runs Fund.stats for one fund in a worker; returns (fundnum, stats, error message)."""
+    try:
+        f = loadfund(fundnum,WORKERSTATE['asofdate'],WORKERSTATE.get('universe'),WORKERSTATE.get('baseuniverse'))
+        return fundnum, f.stats(WORKERSTATE['startdate'],WORKERSTATE['enddate'],WORKERSTATE['mktbasket']), None
+    except Exception as e:
+        return fundnum, None, repr(e)
+
+def streamjob(fundnum):
+    """Loads one fund's return stream in a worker; returns (fundnum, stream, error message)."""
+    try:
+        return fundnum, loadfund(fundnum,WORKERSTATE['asofdate'],WORKERSTATE.get('universe'),WORKERSTATE.get('baseuniverse')).stream, None
+    except Exception as e:
+        return fundnum, None, repr(e)
+
+def runjobs(job, fundnums, state, workers=1):
+    """
+    Runs a fund job for every fund number, in a process pool if workers>1.
+    
+    Parameters
+    ----------
+    job : function
+        module level function taking a fund number (statsjob or streamjob)
+    fundnums : list of ints
+        funds to run
+    state : dict
+        shared inputs of the job, sent once to every worker
+    workers : int (default 1)
+        number of processes; 1 runs the funds serially in this process
+    
+    Returns
+    -------
+    results : list
+        (fundnum, result) tuples of the funds that ran
+    failures : list
+        (fundnum, error message) tuples of the funds that failed
+    """
+    pool = None
+    if workers>1:
+        pool = multiprocessing.Pool(workers,initworker,(state,))
+        outputs = pool.imap_unordered(job,fundnums)
+    else:
+        initworker(state)
+        outputs = itertools.imap(job,fundnums)
+    results, failures = [], []
+    try:
+        for fundnum, result, error in outputs:
+            if error:
+                print fundnum, 'FAILED:', error
+                failures.append((fundnum,error))
+            else:
+                print fundnum
+                results.append((fundnum,result))
+    except BaseException:
+        if pool:
+            pool.terminate() #don't leave workers running after an error or ctrl-c
+        raise
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return results, failures
+
+def graballandoutput(startdate,enddate,mktbasket,asofdate=datetime.datetime.now(),workers=1):
     """
     Loads in all of the funds and runs statistics on them.
     Outputs results to the database.
@@ -471,12 +1224,28 @@ def graballandoutput(startdate,enddate,mktbasket,asofdate=datetime.datetime.now(
         beginning of statistic period
     enddate : datetime
         end of statistic period
-    mktbasket : dict
+    mktbasket : dict or streams.MarketPanel
         dictionary of market streams
     asofdate : datetime (default now())
         date of mappings
+    workers : int (default 1)
+        number of processes to spread the funds over
+    
+    Returns
+    -------
+    failures : list
+        (fundnum, error message) tuples of the funds that failed;
+        the other funds are still written
+    
+    Note
+    ----
+    The delta as of startdate is calculated once, before fundoutput is cleared,
+    so a missing shock workbook raises here instead of failing every fund.
     """
-    cnxn = pyodbc.connect(ORACLESTRING)
+    if not(isinstance(mktbasket, streams.MarketPanel)):
+        mktbasket = streams.MarketPanel(mktbasket) #align every fund against one shared panel
+    deltas = {startdate : cachedelta(startdate)} #one workbook read for all funds
+    cnxn = dbpool.connect()
     cursor = cnxn.cursor()
     sql = 'delete from fundoutput;'
     cursor.execute(sql)
@@ -484,18 +1253,25 @@ def graballandoutput(startdate,enddate,mktbasket,asofdate=datetime.datetime.now(
     sql = 'select fundnum from funddata group by fundnum;'
     cursor.execute(sql)
     fundnums = [int(row[0]) for row in cursor.fetchall()]
-    for fundnum in fundnums:
-        print fundnum
-        if fundnum in basefunds:
-            f = Fund(101,'BASENAV',fundnum,asofdate=asofdate)
-        else:
-            f = AdjFund(fundnum,asofdate=asofdate) #changed it out, obviously
-        f.stats(startdate, enddate, mktbasket, output=True)
+    universe, baseuniverse = batchuniverses() #every fund's NAVs and mappings in one scan per table
+    state = {'startdate' : startdate, 'enddate' : enddate, 'mktbasket' : mktbasket, 'asofdate' : asofdate,
+             'universe' : universe, 'baseuniverse' : baseuniverse, 'fundavs' : {startdate : fundavs(startdate)}, #one AV query for all funds
+             'deltas' : deltas}
+    results, failures = runjobs(statsjob,fundnums,state,workers)
+    rows = [(fundnum,outdata['PROJ'],outdata['ACT'],outdata['DIFF'],outdata['DELTA'],outdata['PL'],
+             startdate,enddate,outdata['TE'],outdata['R2'],outdata['BETA'],outdata['ALPHA'],
+             outdata['VOL'],outdata['AV']) for fundnum, outdata in results if outdata]
+    if rows:
+        cursor.executemany('INSERT INTO FUNDOUTPUT VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?);',
+                           [tuple(float(v) if isinstance(v,scipy.floating) else v for v in row) for row in rows])
+    cnxn.commit()
     cnxn.close()
+    return failures
 
-def errreport(startdate, enddate, threshold=0.03):
+def errreport(startdate, enddate, threshold=0.03, workers=1, thresholds=None, zscore=None):
     """
     Runs the error report on all funds and outputs to the database.
+    The funds' returns are checked together by errorscan.
     
     Parameters
     ----------
@@ -505,27 +1281,39 @@ def errreport(startdate, enddate, threshold=0.03):
         end of error period
     threshold : float (default 0.03)
         threshold to detect errors
+    workers : int (default 1)
+        number of processes to load the funds with
+    thresholds : dict (default None)
+        fundnum : threshold for the funds that don't use the default threshold
+    zscore : float (default None)
+        if given, also flag returns more than zscore standard deviations
+        away from the fund's mean return in the period
+    
+    Returns
+    -------
+    failures : list
+        (fundnum, error message) tuples of the funds that failed;
+        the other funds are still written
     """
-    cnxn = pyodbc.connect(ORACLESTRING)
+    cnxn = dbpool.connect()
     cursor = cnxn.cursor()
     cursor.execute('delete from funderrors;')
-    cursor.commit()
+    cnxn.commit()
     sql = 'select fundnum from funddata group by fundnum;'
     cursor.execute(sql)
     fundnums = [int(row[0]) for row in cursor.fetchall()]
-    for fundnum in fundnums:
-        print fundnum
-        if fundnum in basefunds:
-            f = Fund(101,'BASENAV',fundnum)
-        else:
-            f = AdjFund(fundnum)
-        errval = f.error(startdate,enddate,threshold=threshold)
-        if errval[0]:
-            for myval in errval[1]:
-                sql = 'insert into funderrors values('+str(fundnum)+','+oracledatebuilder(myval[0])+','+str(myval[1])+');'
-                cursor.execute(sql)
-    cursor.commit()
+    universe, baseuniverse = batchuniverses(loadmappings=False)
+    state = {'asofdate' : datetime.datetime.now(), 'universe' : universe, 'baseuniverse' : baseuniverse}
+    results, failures = runjobs(streamjob,fundnums,state,workers)
+    thresholds = thresholds if thresholds else {}
+    limits = [thresholds.get(fundnum,threshold) for fundnum, stream in results]
+    errs = errorscan([stream for fundnum, stream in results],startdate,enddate,limits,zscore)
+    rows = [(results[i][0],dt,ret) for i, dt, ret in errs]
+    if rows:
+        cursor.executemany('insert into funderrors values(?,?,?);',rows)
+    cnxn.commit()
     cnxn.close()
+    return failures
     
 if __name__=='__main__':
     mkt = streams.getmarketdatadb()
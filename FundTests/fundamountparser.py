@@ -1,38 +1,51 @@
-import pyodbc, datetime, csv, sqlite3
-import fund, streams, os, xlrd
+import datetime, csv, sqlite3
+import fund, streams
+import dbpool
+import pfuvparser
+import deltacache
+import numpy
 
 DBLOC = 'j:\\valuation\\output\\'
 PWD = 'tdees_3'
 DBNAME = 'OracleDB'
-ORACLESTRING = 'DSN=%s;PWD=%s' % (DBNAME, PWD)
+ORACLESTRING = dbpool.oraclestring(DBNAME, PWD)
+POOLNAME = 'fundamountparser' #dbpool name of this module's database
+dbpool.register(POOLNAME, ORACLESTRING)
 
 FILENAME = 'H:\dat\PFUVFILE.TXT'
 #SQLLITEDB = 'c:\\sqlite\\funddata2.db'
 SQLLITEDB = 'c:\\temp\\funddata.db'
 
-def importdata(filename=FILENAME,sqllitedb=SQLLITEDB):
+def importdata(filename=FILENAME,sqllitedb=SQLLITEDB,incremental=False,lookback=7):
     conn = sqlite3.connect(sqllitedb)
     c = conn.cursor()
-    try:
-        c.execute('DROP TABLE funds;')
-    except:
-        pass
-    c.execute('CREATE TABLE funds (company INTEGER, mnemonic TEXT, date TEXT, fundnum INTEGER, nav REAL);')
-    f = open(filename)
-    row = f.readline()
-    while row:
-        if row[0]=='U':
-            company = int(row[1:4])
-            mnemonic = row[4:12].strip()
-            date = row[12:16]+'-'+row[16:18]+'-'+row[18:20]
-            fundcount = int(row[20:23])
-            for i in range(0,fundcount):
-                fundnum = int(row[23+i*12:23+i*12+3])
-                nav=int(row[26+i*12:26+i*12+9])/1000000.0
-                sql = "INSERT INTO funds VALUES(%s, '%s', '%s', %s, %s);" % (str(company), mnemonic, date, str(fundnum),str(nav))
-                c.execute(sql)
-        row = f.readline()
-    c.execute('CREATE UNIQUE INDEX pkey on funds(company ASC,mnemonic ASC, fundnum ASC, date ASC);')
+    watermarks = {}
+    if incremental:
+        c.execute('CREATE TABLE IF NOT EXISTS funds (company INTEGER, mnemonic TEXT, date TEXT, fundnum INTEGER, nav REAL);')
+        c.execute('CREATE UNIQUE INDEX IF NOT EXISTS pkey on funds(company ASC,mnemonic ASC, fundnum ASC, date ASC);')
+        c.execute('CREATE TABLE IF NOT EXISTS fundsmarks (company INTEGER, mnemonic TEXT, date TEXT);')
+        c.execute('SELECT company, mnemonic, date FROM fundsmarks;')
+        for row in c.fetchall():
+            watermarks[(int(row[0]),str(row[1]))] = str(row[2])
+    else:
+        try:
+            c.execute('DROP TABLE funds;')
+        except:
+            pass
+        c.execute('CREATE TABLE funds (company INTEGER, mnemonic TEXT, date TEXT, fundnum INTEGER, nav REAL);')
+        c.execute('CREATE TABLE IF NOT EXISTS fundsmarks (company INTEGER, mnemonic TEXT, date TEXT);')
+    newmarks = dict(watermarks)
+    for records in pfuvparser.iterchunks(filename):
+        if incremental:
+            records = pfuvparser.afterwatermark(records,watermarks,lookback)
+        pfuvparser.updatewatermarks(records,newmarks)
+        #upsert, so NAVs corrected within the lookback window replace the old rows
+        c.executemany('INSERT OR REPLACE INTO funds VALUES(?, ?, ?, ?, ?);',pfuvparser.torows(records,datestrings=True))
+    if not(incremental):
+        c.execute('CREATE UNIQUE INDEX pkey on funds(company ASC,mnemonic ASC, fundnum ASC, date ASC);')
+    c.execute('DELETE FROM fundsmarks;')
+    c.executemany('INSERT INTO fundsmarks VALUES(?, ?, ?);',
+                  [(company,mnemonic,str(numpy.datetime64(mark,'D'))) for (company,mnemonic), mark in newmarks.items()])
     conn.commit()
     conn.close()
 
@@ -41,7 +54,7 @@ def oracledatebuilder(mydate):
     return "TO_DATE('"+mydate.strftime('%Y%m%d')+"','yyyymmdd')"
 
 def getmarketreturns(startdate,enddate):
-    marketdata = streams.getmarketdatadb(ORACLESTRING)
+    marketdata = streams.getmarketdatadb(POOLNAME)
     indexnames = ['SPX','AGG','EAFE','RTY','TBILL']
     returndict = {}
     for index in indexnames:
@@ -50,7 +63,7 @@ def getmarketreturns(startdate,enddate):
     return returndict
 
 def calcspxpct(evaldate):
-    cnxn = pyodbc.connect(ORACLESTRING)
+    cnxn = dbpool.connect(POOLNAME)
     c = cnxn.cursor()
     sql = "SELECT Sum(CASH) as BILL, Sum(BOND) as BND, Sum(SMALL_CAP) as RTY, Sum(LARGE_CAP) as SPX, "
     sql += "Sum(INTERNATIONAL) as EAFE, Sum(FIXED) as FXD, Sum(DCA_PLUS) as DCA FROM ODSACT.ACT_RSL_SERIATIM WHERE "
@@ -60,21 +73,11 @@ def calcspxpct(evaldate):
     cnxn.close()
     return row.SPX / (row.BILL + row.BND + row.RTY + row.SPX+row.EAFE+row.FXD+row.DCA)
 
-def getdelta(deltadate):
-    shocklocation = '\\\\anpdnas1\\chp_prod$\\Trading\Model\\'+str(deltadate.year)+'\\'+deltadate.strftime('%Y%m')+'\\'+deltadate.strftime('%Y%m%d')+'\\'
-    files = os.listdir(shocklocation)
-    filename = filter(lambda x: x[-3:]=='xls', files)[0]
-    wb = xlrd.open_workbook(shocklocation+filename)
-    sht = wb.sheet_by_name('VAHA_Output')
-    startval = 2 if sht.cell(0,1).value=='CSA' else 1
-    upshock = sum([sht.cell(2,i).value for i in range(startval,startval+6)])
-    downshock = sum([sht.cell(3,i).value for i in range(startval,startval+6)])
-    spxdelta = -(upshock-downshock)/2.0
-    scalefactor = calcspxpct(deltadate)
-    return spxdelta/scalefactor
+def getdelta(deltadate, cache=None):
+    return deltacache.getdelta(deltadate,calcspxpct,cache)
     
 def loadfundamounts(funddate):
-    cnxn = pyodbc.connect(ORACLESTRING)
+    cnxn = dbpool.connect(POOLNAME)
     cursor = cnxn.cursor()
     sql = "SELECT PRODUCT_FUND_ID, Sum(Fund_Val) AS FundTotal FROM ODSACT.ACT_PRC_CONTRACT_FUND_VALUE WHERE GENERATION_DATE="
     sql += oracledatebuilder(funddate) + " AND GENERATION_TYPE='W' GROUP BY PRODUCT_FUND_ID;"
@@ -101,7 +104,7 @@ def loadfundamounts(funddate):
     return fundnum, mnemonics, fundamt
 
 def loadhighlevelfundamounts(funddate):
-    cnxn = pyodbc.connect(ORACLESTRING)
+    cnxn = dbpool.connect(POOLNAME)
     cursor = cnxn.cursor()
     sql = "SELECT SUBSTR(PRODUCT_FUND_ID,-3), Sum(Fund_Val) AS FundTotal FROM ODSACT.ACT_PRC_CONTRACT_FUND_VALUE WHERE GENERATION_DATE="
     sql += oracledatebuilder(funddate) + " AND GENERATION_TYPE='W' GROUP BY SUBSTR(PRODUCT_FUND_ID,-3);"
@@ -116,7 +119,7 @@ def loadhighlevelfundamounts(funddate):
     
 
 def getmappings(date):
-    cnxn = pyodbc.connect(ORACLESTRING)
+    cnxn = dbpool.connect(POOLNAME)
     c=cnxn.cursor()
     datestring = oracledatebuilder(date)
     sql = "SELECT * FROM ODSACT.ACT_SRC_FUND_MAPPING WHERE START_DATE<="+datestring
@@ -134,71 +137,80 @@ def getmappings(date):
     cnxn.close()
     return mappings,trans
 
-def calchlfundperformance(startdate,enddate):
+def perfrows(startdate, enddate, funds, delta):
+    """
+    Allocates the delta to funds by AV and builds their fundperf rows.
+    funds holds (mnemonic, fundnum, fundname, fundamount, actual, expected) tuples;
+    each fund gets fundamount/total of delta, and a P&L of that delta times its diff per 1%.
+    """
+    if not(funds):
+        return []
+    mnemonics, fundnums, fundnames, amounts, actuals, expecteds = zip(*funds)
+    amounts, actuals, expecteds = numpy.array(amounts), numpy.array(actuals,dtype=float), numpy.array(expecteds,dtype=float)
+    diffs = actuals-expecteds
+    totalamt = amounts.sum()
+    deltaallocs = amounts/totalamt*delta if totalamt else numpy.zeros(amounts.size)
+    pls = deltaallocs*diffs/.01
+    period = [startdate.strftime('%Y-%m-%d')]*amounts.size, [enddate.strftime('%Y-%m-%d')]*amounts.size
+    return zip(mnemonics,fundnums,period[0],period[1],fundnames,amounts.tolist(),actuals.tolist(),
+               expecteds.tolist(),diffs.tolist(),deltaallocs.tolist(),pls.tolist())
+
+def writefundperf(c, startdate, enddate, rows):
+    """Replaces the fundperf rows of a period with one DELETE and one executemany."""
+    c.execute("DELETE FROM fundperf WHERE startdate=? and enddate=?;",(startdate.strftime('%Y-%m-%d'),enddate.strftime('%Y-%m-%d')))
+    c.executemany("INSERT INTO fundperf VALUES(?,?,?,?,?,?,?,?,?,?,?);",rows)
+
+def calchlfundperformance(startdate,enddate,delta=None):
     fundnums, fundamts = loadhighlevelfundamounts(startdate)
-    delta = getdelta(startdate)
+    delta = getdelta(startdate) if delta is None else delta
     returns = getmarketreturns(startdate,enddate)
     mappings,trans = getmappings(startdate)
-    conn = sqlite3.connect(SQLLITEDB)
-    c = conn.cursor()
-    try:
-        sql = "DELETE FROM fundperf WHERE startdate='"+startdate.strftime('%Y-%m-%d')+"' and enddate='"+enddate.strftime('%Y-%m-%d')+"';"
-        c.execute(sql)
-    except:
-        sql = 'CREATE TABLE fundperf(mnemonic TEXT, fundnum INTEGER, startdate TEXT, enddate TEXT, fundname TEXT, fundamount REAL, actual REAL, expected REAL, diff REAL, delta REAL, pl REAL);'
-        c.execute(sql)    
-    totalamt = 0.0
+    funds = []
     for mynum, myamt in zip(fundnums,fundamts):
         if mynum in mappings.keys():
             myfund = fund.companycodefinder(mnemonic='',code=mynum,mapping=mappings[mynum],freq='D')
             if myfund:
-                totalamt += myamt
-                actual=myfund.actualreturn(startdate,enddate)
-                expected=myfund.projectedreturn(returns)
-                diff=actual-expected
-                sql = "INSERT INTO fundperf VALUES('',"+str(mynum)+",'"+startdate.strftime('%Y-%m-%d')+"','"+enddate.strftime('%Y-%m-%d')+"','"+trans[mynum]+"',"+str(myamt)+","+str(actual)+","+str(expected)+","+str(diff)+",0.0,0.0);"
-                c.execute(sql)
-    sql = "SELECT * from fundperf WHERE startdate='"+startdate.strftime('%Y-%m-%d')+"' AND enddate='"+enddate.strftime('%Y-%m-%d')+"';"
-    c.execute(sql)
-    for row in c.fetchall():
-        deltaalloc = row[5]/totalamt * delta
-        pl = deltaalloc * row[8]/.01
-        sql = "UPDATE fundperf SET delta="+str(deltaalloc)+", pl=" + str(pl)+" WHERE mnemonic='"+row[0]+"' AND fundnum="+str(row[1])+" AND startdate='"+startdate.strftime('%Y-%m-%d')+"' AND enddate='"+enddate.strftime('%Y-%m-%d')+"';"
-        c.execute(sql)
+                funds.append(('',mynum,trans[mynum],myamt,myfund.actualreturn(startdate,enddate),myfund.projectedreturn(returns)))
+    conn = sqlite3.connect(SQLLITEDB)
+    c = conn.cursor()
+    c.execute('CREATE TABLE IF NOT EXISTS fundperf(mnemonic TEXT, fundnum INTEGER, startdate TEXT, enddate TEXT, fundname TEXT, fundamount REAL, actual REAL, expected REAL, diff REAL, delta REAL, pl REAL);')
+    writefundperf(c,startdate,enddate,perfrows(startdate,enddate,funds,delta))
     conn.commit()
     conn.close()
 
 
-def calcfundperformance(startdate,enddate):
+def calcfundperformance(startdate,enddate,delta=None):
     fundnums, mnemonics, fundamts = loadfundamounts(startdate)
-    delta = getdelta(startdate)
+    delta = getdelta(startdate) if delta is None else delta
     returns = getmarketreturns(startdate,enddate)
     mappings,trans = getmappings(startdate)
-    conn = connect(SQLLITEDB)
-    c = conn.cursor()
-    sql = "DELETE FROM fundperf WHERE startdate='"+startdate.strftime('%Y-%m-%d')+"' and enddate='"+enddate.strftime('%Y-%m-%d')+"';"
-    c.execute(sql)
-    totalamt = 0.0
+    funds = []
     for mynum, mymne, myamt in zip(fundnums,mnemonics,fundamts):
         if mynum in mappings.keys():
             myfund = fund.companycodefinder(mnemonic=mymne,code=mynum,mapping=mappings[mynum],freq='D')
             if myfund:
-                totalamt += myamt
-                actual=myfund.actualreturn(startdate,enddate)
-                expected=myfund.projectedreturn(returns)
-                diff=actual-expected
-                sql = "INSERT INTO fundperf VALUES('"+mymne+"',"+str(mynum)+",'"+startdate.strftime('%Y-%m-%d')+"','"+enddate.strftime('%Y-%m-%d')+"','"+trans[mynum]+"',"+str(myamt)+","+str(actual)+","+str(expected)+","+str(diff)+",0.0,0.0);"
-                c.execute(sql)
-    sql = "SELECT * from fundperf WHERE startdate='"+startdate.strftime('%Y-%m-%d')+"' AND enddate='"+enddate.strftime('%Y-%m-%d')+"';"
-    c.execute(sql)
-    for row in c.fetchall():
-        deltaalloc = row[5]/totalamt * delta
-        pl = deltaalloc * row[8]/.01
-        sql = "UPDATE fundperf SET delta="+str(deltaalloc)+", pl=" + str(pl)+" WHERE mnemonic='"+row[0]+"' AND fundnum="+str(row[1])+" AND startdate='"+startdate.strftime('%Y-%m-%d')+"' AND enddate='"+enddate.strftime('%Y-%m-%d')+"';"
-        c.execute(sql)
+                funds.append((mymne,mynum,trans[mynum],myamt,myfund.actualreturn(startdate,enddate),myfund.projectedreturn(returns)))
+    conn = sqlite3.connect(SQLLITEDB)
+    c = conn.cursor()
+    writefundperf(c,startdate,enddate,perfrows(startdate,enddate,funds,delta))
     conn.commit()
     conn.close()
 
+def calcperiods(dates, highlevel=True, cache=None, workers=8):
+    """
+    Runs the fund performance for many (startdate, enddate) periods, with the
+    deltas of all the start dates read up front by a thread pool (see deltacache.prefetch).
+    A period whose delta failed is calculated with getdelta as before.
+    """
+    cache = deltacache.DeltaCache() if cache is None else cache
+    deltas, failures = deltacache.prefetch([startdate for startdate, enddate in dates],calcspxpct,cache,workers)
+    for startdate, enddate in dates:
+        print 'RUNNING: ' + enddate.strftime('%Y%m%d')
+        if highlevel:
+            calchlfundperformance(startdate,enddate,deltas.get(startdate))
+        else:
+            calcfundperformance(startdate,enddate,deltas.get(startdate))
+
 def outputall(filename='out.csv'):
     conn = sqlite3.connect(SQLLITEDB)
     c = conn.cursor()
@@ -254,7 +266,8 @@ if __name__=='__main__':
     #PWD = raw_input('Input Oracle DB password: ')
     PWD = 'tdees_2'
     DBNAME = 'OracleDB'
-    ORACLESTRING = 'DSN=%s;PWD=%s' % (DBNAME, PWD)
+    ORACLESTRING = dbpool.oraclestring(DBNAME, PWD)
+    dbpool.register(POOLNAME, ORACLESTRING)
     strp = lambda k : datetime.datetime.strptime(k,'%Y%m%d')
     dates = [(strp(initialdate),strp(enddate))]
     importdata()
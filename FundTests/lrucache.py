@@ -0,0 +1,53 @@
+import threading
+import collections
+
+class LRUCache:
+    def __init__(self, maxsize=256):
+        """
+        Constructor for class to memoize values by key, dropping the least recently used
+        key beyond maxsize entries so long-running processes don't grow without limit.
+        
+        Parameters
+        ----------
+        maxsize : int (default 256)
+            number of entries kept
+        """
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits, self.misses = 0, 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, loader):
+        """Returns the value stored for key, or calls loader(key) and stores the result."""
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                value = self.entries.pop(key)
+                self.entries[key] = value #most recently used goes last
+                return value
+            self.misses += 1
+        value = loader(key)
+        self.put(key,value)
+        return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key,None)
+            self.entries[key] = value
+            while len(self.entries)>self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits, self.misses = 0, 0
+
+    def info(self):
+        """Returns a dict of the hit and miss counts and the current and maximum sizes."""
+        return {'hits' : self.hits, 'misses' : self.misses, 'size' : len(self.entries), 'maxsize' : self.maxsize}
@@ -0,0 +1,176 @@
+import os
+import json
+import numpy
+import dbpool
+
+CACHEDIR = 'c:\\temp\\navcache\\' #local directory holding the cached series
+MANIFEST = 'manifest.json' #index of the valid entries and their watermarks
+
+def fundkey(company, mnemonic, fundnum):
+    """Cache name of a fund's NAV series."""
+    return 'fund_%s_%s_%s' % (str(company), mnemonic, str(fundnum))
+
+def marketkey(index):
+    """Cache name of a market index's quote series."""
+    return 'market_%s' % index
+
+def currentwatermark(dbstring=None, tablename='funddatamarks'):
+    """
+    Reads the latest imported NAV date (see fund.importdata) with one query,
+    to be used as the watermark of a NAVCache (dbstring None is the dbpool default).
+    """
+    cnxn = dbpool.connect(dbstring)
+    c = cnxn.cursor()
+    c.execute('SELECT MAX(navdate) FROM %s;' % tablename)
+    row = c.fetchone()
+    cnxn.close()
+    return row[0] if row else None
+
+MANIFESTBATCH = 64 #puts between manifest writes, see NAVCache.flush
+
+class NAVCache:
+    def __init__(self, directory=CACHEDIR, watermark=None, batchsize=MANIFESTBATCH):
+        """
+        Constructor for class to hold NAV and market series on local disk.
+        Each series is a pair of .npy files (datetime64 dates and float quotes)
+        that is memory-mapped on load, so warm starts don't copy or query anything.
+        
+        Parameters
+        ----------
+        directory : string (default CACHEDIR)
+            where the series are stored
+        watermark : datetime or string (default None)
+            entries stored with an older watermark are treated as stale;
+            if None, every stored entry is valid
+        batchsize : int (default MANIFESTBATCH)
+            the manifest is written once every batchsize puts, and by flush
+        
+        Note
+        ----
+        Windows can't replace or remove a file while it is mapped, and the arrays
+        returned by get live on inside the streams built from them. So every put
+        writes a new pair of files named in the manifest, and the files it replaces
+        are removed when nothing maps them any more (see sweep).
+        """
+        self.directory = directory
+        self.watermark = None if watermark is None else str(watermark)
+        self.batchsize = batchsize
+        self.pending = 0
+        self.stale = [] #replaced files that were still mapped when removed
+        if not(os.path.isdir(directory)):
+            os.makedirs(directory)
+        manifestfile = os.path.join(directory,MANIFEST)
+        self.manifest = json.load(open(manifestfile)) if os.path.exists(manifestfile) else {}
+
+    def entry(self, name):
+        """Returns the (watermark, file stem) of a stored entry."""
+        entry = self.manifest[name]
+        if isinstance(entry,list):
+            return entry[0], entry[1]
+        return entry, name #written before entries had their own file stems
+
+    def paths(self, name, stem=None):
+        """Returns the file names of the dates and the quotes of an entry (or of a file stem)."""
+        stem = self.entry(name)[1] if stem is None else stem
+        return (os.path.join(self.directory,stem+'.dates.npy'),
+                os.path.join(self.directory,stem+'.quotes.npy'))
+
+    def savemanifest(self):
+        manifestfile = os.path.join(self.directory,MANIFEST)
+        f = open(manifestfile+'.tmp','w')
+        json.dump(self.manifest,f)
+        f.close()
+        if os.path.exists(manifestfile):
+            os.remove(manifestfile)
+        os.rename(manifestfile+'.tmp',manifestfile)
+        self.pending = 0
+
+    def flush(self):
+        """Writes the manifest if any put since the last write is missing from it."""
+        if self.pending:
+            self.savemanifest()
+        self.sweep()
+
+    def sweep(self):
+        """Removes the replaced files that are no longer mapped, and keeps the others for later."""
+        stale, self.stale = sorted(set(self.stale)), []
+        for filename in stale:
+            try:
+                if os.path.exists(filename):
+                    os.remove(filename)
+            except OSError:
+                self.stale.append(filename) #still mapped by a live array
+
+    def valid(self, name):
+        """Returns True if name is stored and not older than the cache's watermark."""
+        if not(name in self.manifest):
+            return False
+        return self.watermark is None or self.entry(name)[0]>=self.watermark
+
+    def get(self, name):
+        """
+        Loads an entry.
+        
+        Returns
+        -------
+        dates : 1-d datetime64 array
+        quotes : 1-d array
+            both read-only, memory-mapped from the cache files
+        or None, None if the entry is missing or stale
+        """
+        if not(self.valid(name)):
+            return None, None
+        datefile, quotefile = self.paths(name)
+        return numpy.load(datefile,mmap_mode='r'), numpy.load(quotefile,mmap_mode='r')
+
+    def put(self, name, dates, quotes, watermark=None):
+        """
+        Stores an entry. The manifest is only written every batchsize puts,
+        so call flush once a batch of puts is done.
+        
+        Parameters
+        ----------
+        name : string
+            see fundkey and marketkey
+        dates : list of datetimes or datetime64 array
+        quotes : 1-d array
+        watermark : datetime or string (default None)
+            validity of the data; defaults to the cache's watermark
+        """
+        old = self.paths(name) if name in self.manifest else ()
+        version = 0
+        while any([os.path.exists(filename) for filename in self.paths(name,'%s.%d' % (name,version))]):
+            self.stale.extend(self.paths(name,'%s.%d' % (name,version))) #older versions, also ones left unlisted
+            version += 1
+        stem = '%s.%d' % (name,version)
+        datefile, quotefile = self.paths(name,stem)
+        numpy.save(datefile,numpy.asarray(dates,dtype='datetime64[us]'))
+        numpy.save(quotefile,numpy.asarray(quotes,dtype=float))
+        mark = watermark if watermark is not None else self.watermark
+        self.manifest[name] = ['' if mark is None else str(mark), stem]
+        self.stale.extend(old)
+        self.pending += 1
+        if self.pending>=self.batchsize:
+            self.flush()
+
+    def fetch(self, name, loader):
+        """
+        Loads an entry, calling loader() for (dates, quotes) and storing
+        the result if it is missing or stale.
+        """
+        dates, quotes = self.get(name)
+        if dates is None:
+            dates, quotes = loader()
+            self.put(name,dates,quotes)
+            dates, quotes = self.get(name)
+        return dates, quotes
+
+    def invalidate(self, name=None):
+        """Drops one entry, or every entry if name is None."""
+        names = self.manifest.keys() if name is None else [name]
+        for myname in names:
+            if myname in self.manifest:
+                self.stale.extend(self.paths(myname))
+                self.manifest.pop(myname)
+        self.savemanifest()
+        self.sweep()
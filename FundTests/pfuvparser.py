@@ -0,0 +1,152 @@
+import mmap
+import os
+import numpy
+
+CHUNKSIZE = 64*1024*1024 #bytes of PFUVFILE decoded per chunk
+HEADERSIZE = 23 #'U', company, mnemonic, date and fund count
+BLOCKSIZE = 12 #fund number and NAV of one fund
+RECORDTYPE = numpy.dtype([('company','i4'),('mnemonic','S8'),('date','datetime64[D]'),
+                          ('fundnum','i4'),('nav','f8')])
+
+def digits(buf, starts, width):
+    """Decodes fixed-width unsigned integers starting at each position in starts (spaces count as 0)."""
+    cells = buf[starts[:,None]+numpy.arange(width)].astype(numpy.int64)
+    cells = numpy.where(cells==32,0,cells-48)
+    return cells.dot(10**numpy.arange(width-1,-1,-1,dtype=numpy.int64))
+
+def parsebuffer(buf, mnemonics=None, basename=''):
+    """
+    Decodes a block of complete PFUVFILE lines.
+    
+    Parameters
+    ----------
+    buf : 1-d uint8 array
+        bytes of whole lines
+    mnemonics : list of strings (default None)
+        if given, only lines with these mnemonics are decoded
+    basename : string (default '')
+        mnemonic given to the blank (base NAV) mnemonic
+    
+    Returns
+    -------
+    records : structured array of RECORDTYPE
+        one record per fund NAV, in file order
+    """
+    ends = numpy.flatnonzero(buf==10)
+    if ends.size==0 or ends[-1]!=buf.size-1:
+        ends = numpy.append(ends,buf.size) #last line without a newline
+    starts = numpy.concatenate(([0],ends[:-1]+1))
+    keep = (starts<ends) & (buf[numpy.minimum(starts,buf.size-1)]==ord('U'))
+    starts, ends = starts[keep], ends[keep]
+    names = numpy.ascontiguousarray(buf[starts[:,None]+numpy.arange(4,12)]).view('S8').flatten()
+    names = numpy.char.strip(names)
+    names[names==''] = basename
+    if mnemonics is not None:
+        keep = numpy.in1d(names,numpy.asarray(mnemonics,dtype='S8'))
+        starts, ends, names = starts[keep], ends[keep], names[keep]
+    counts = digits(buf,starts+20,3)
+    lineindex = numpy.repeat(numpy.arange(starts.size),counts)
+    blocknum = numpy.arange(lineindex.size)-numpy.repeat(numpy.cumsum(counts)-counts,counts)
+    blockstarts = starts[lineindex]+HEADERSIZE+BLOCKSIZE*blocknum
+    if numpy.any(blockstarts+BLOCKSIZE>ends[lineindex]):
+        raise ValueError('PFUVFILE line shorter than its fund count')
+    dates = (digits(buf,starts+12,4)-1970).astype('datetime64[Y]').astype('datetime64[M]')
+    dates = (dates+(digits(buf,starts+16,2)-1)).astype('datetime64[D]')+(digits(buf,starts+18,2)-1)
+    records = numpy.zeros(lineindex.size,dtype=RECORDTYPE)
+    records['company'] = digits(buf,starts+1,3)[lineindex]
+    records['mnemonic'] = names[lineindex]
+    records['date'] = dates[lineindex]
+    records['fundnum'] = digits(buf,blockstarts,3)
+    records['nav'] = digits(buf,blockstarts+3,9)/1000000.0
+    return records
+
+def iterchunks(filename, mnemonics=None, basename='', chunksize=CHUNKSIZE):
+    """
+    Memory-maps a PFUVFILE and decodes it chunk by chunk, so files
+    larger than memory can be streamed into any sink.
+    
+    Parameters
+    ----------
+    filename : string
+        filename of text file to parse
+    mnemonics : list of strings (default None)
+        if given, only lines with these mnemonics are decoded
+    basename : string (default '')
+        mnemonic given to the blank (base NAV) mnemonic
+    chunksize : int (default CHUNKSIZE)
+        approximate number of bytes per chunk; chunks end on a line break
+    
+    Yields
+    ------
+    records : structured array of RECORDTYPE
+        see parsebuffer
+    """
+    size = os.path.getsize(filename)
+    if size==0:
+        return
+    f = open(filename,'rb')
+    try:
+        mm = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        try:
+            position = 0
+            while position<size:
+                end = min(position+chunksize,size)
+                if end<size:
+                    linebreak = mm.find(b'\n',end-1)
+                    end = size if linebreak<0 else linebreak+1
+                yield parsebuffer(numpy.frombuffer(mm,numpy.uint8,end-position,position),mnemonics,basename)
+                position = end
+        finally:
+            mm.close()
+    finally:
+        f.close()
+
+def torows(records, datestrings=False):
+    """
+    Converts decoded records into (company, mnemonic, date, fundnum, nav) tuples for executemany.
+    
+    Parameters
+    ----------
+    records : structured array of RECORDTYPE
+        see parsebuffer
+    datestrings : bool (default False)
+        if True, dates are 'YYYY-MM-DD' strings, otherwise datetimes
+    """
+    if datestrings:
+        dates = numpy.datetime_as_string(records['date']).tolist()
+    else:
+        dates = records['date'].astype('datetime64[us]').tolist()
+    return zip(records['company'].tolist(),records['mnemonic'].tolist(),dates,
+               records['fundnum'].tolist(),records['nav'].tolist())
+
+def afterwatermark(records, watermarks, lookback=0):
+    """
+    Keeps the records that are newer than the high-water mark of their company/mnemonic.
+    
+    Parameters
+    ----------
+    records : structured array of RECORDTYPE
+        see parsebuffer
+    watermarks : dict
+        (company, mnemonic) : last imported NAV date (datetime or 'YYYY-MM-DD')
+    lookback : int (default 0)
+        number of days before the mark that are also kept,
+        so that corrected NAVs are picked up again
+    """
+    keep = numpy.ones(records.size,dtype=bool)
+    for (company, mnemonic), mark in watermarks.items():
+        cutoff = numpy.datetime64(mark,'D')-lookback
+        match = (records['company']==company) & (records['mnemonic']==str(mnemonic))
+        keep &= ~match | (records['date']>cutoff)
+    return records[keep]
+
+def updatewatermarks(records, watermarks):
+    """Raises the (company, mnemonic) high-water marks in watermarks to the latest dates in records."""
+    for company in numpy.unique(records['company']):
+        ofcompany = records[records['company']==company]
+        for mnemonic in numpy.unique(ofcompany['mnemonic']):
+            latest = ofcompany['date'][ofcompany['mnemonic']==mnemonic].max().astype('datetime64[us]').tolist()
+            key = (int(company),str(mnemonic))
+            if key not in watermarks or numpy.datetime64(watermarks[key],'D')<numpy.datetime64(latest,'D'):
+                watermarks[key] = latest
+    return watermarks
@@ -1,37 +1,118 @@
 import openpyxl
 import datetime
-import pyodbc
-from fund import ORACLESTRING
+import itertools
+import multiprocessing
+import numpy
+import dbpool
 
 FILENAME = "I:\\Data\\Actuary\\Risk Management - Equity Market\\Fund Analysis\\Return Data\\PLFA\\Individual Fund Returns 1-2-02 to 6-28-13.xlsx"
+SHEETNAME = 'Fund Returns - Daily'
 
-def importssdata(filenames):
-    cnxn = pyodbc.connect(ORACLESTRING)
+def parsedate(value):
+    """Converts a date cell, either a datetime or an mm/dd/yyyy string."""
+    if isinstance(value,datetime.datetime):
+        return value
+    return datetime.datetime.strptime(value,'%m/%d/%Y')
+
+def parseworkbook(filename):
+    """
+    Reads the fund returns out of a workbook in one streaming sweep over its rows.
+    Row 2 holds the fund names, and from row 3 down column 1 holds the dates and
+    each fund column its returns until its first blank cell. The fund columns
+    start at column 2 and run up to the first blank cell of row 3.
+
+    Returns
+    -------
+    funds : list
+        (fundname, dates, returns) tuples, with the zero returns left out
+    """
+    wb = openpyxl.load_workbook(filename,read_only=True,data_only=True)
+    ws = wb[SHEETNAME]
+    rows = ws.iter_rows()
+    next(rows,None)
+    names = [cell.value for cell in next(rows,[])][1:]
+    datecells, blocks = [], []
+    alive = None
+    for row in rows:
+        values = [cell.value for cell in row]
+        if alive is None:
+            #the fund columns are the ones filled in on the first row of returns
+            count = len(list(itertools.takewhile(lambda value : value is not None, values[1:])))
+            alive = numpy.ones(count,dtype=bool)
+        datecell = values[0] if values else None
+        values = numpy.array((values[1:count+1]+[None]*count)[:count],dtype=object)
+        alive &= numpy.not_equal(values,None)
+        if not(alive.any()):
+            break
+        values[~alive] = None #a fund's returns end at its first blank cell
+        datecells.append(datecell)
+        blocks.append(values)
+    if hasattr(wb,'close'):
+        wb.close()
+    if not(blocks):
+        return []
+    block = numpy.array(blocks,dtype=object).reshape(len(blocks),count)
+    keep = numpy.not_equal(block,None) & numpy.not_equal(block,0.0)
+    used = numpy.flatnonzero(keep.any(axis=1))
+    dates = dict((i,parsedate(datecells[i])) for i in used) #each row's date is parsed once
+    funds = []
+    for j in range(0,count):
+        positions = numpy.flatnonzero(keep[:,j])
+        funds.append((names[j],[dates[i] for i in positions],block[positions,j].astype(float).tolist()))
+    return funds
+
+def importssdata(filenames, tablename='fundreturns', batchsize=5000, workers=None):
+    """
+    Imports the fund returns of workbooks into the database.
+
+    Parameters
+    ----------
+    filenames : list of strings
+        workbooks to import, see parseworkbook
+    tablename : string (default 'fundreturns')
+        table the (fundnum, returndate, ret) rows go to; the imported
+        funds' existing rows are replaced
+    batchsize : int (default 5000)
+        number of rows sent per executemany
+    workers : int (default None)
+        number of processes parsing the workbooks;
+        if None, one per workbook up to the number of CPUs
+
+    Returns
+    -------
+    unmatched : list
+        fund names without a row in fundnamecode, which aren't imported
+    """
+    workers = workers if workers else min(len(filenames),multiprocessing.cpu_count())
+    if workers>1:
+        pool = multiprocessing.Pool(workers)
+        parsed = pool.map(parseworkbook,filenames)
+        pool.close()
+        pool.join()
+    else:
+        parsed = map(parseworkbook,filenames)
+    cnxn = dbpool.connect()
     c = cnxn.cursor()
-    #c.execute('delete from funddata;')
-    #c.commit()
-    for filename in filenames:
-        wb = openpyxl.load_workbook(filename)
-        ws = wb.get_sheet_by_name('Fund Returns - Daily')
-        colnum = 2
-        while not(ws.cell(row=3,column=colnum).value==None):
-            dates, returns = [],[]
-            rownum = 3
-            while ws.cell(row=rownum,column=colnum).value==None:
-                rownum+=1
-            while not(ws.cell(row=rownum,column=colnum).value==None):
-                returnval = ws.cell(row=rownum,column=colnum).value
-                if returnval!=0.0:
-                    dte = datetime.datetime.strptime(ws.cell(row=rownum,column=1).value,'%m/%d/%Y')
-                    dates.append(dte)
-                    returns.append(returnval)           
-                rownum+=1
-            fundname = ws.cell(row=2,column=colnum).value
-            print fundname, dates, returns
-            c.execute("select * from fundnamecode where mappingname=''" % (fundname))
-            row = c.fetchone()
-            fundnum = row[2]
-            colnum+=1
+    c.execute('select * from fundnamecode;')
+    fundnums = dict((row.MAPPINGNAME,row[2]) for row in c.fetchall())
+    try:
+        c.execute('CREATE TABLE %s (fundnum NUMBER, returndate DATE, ret NUMBER);' % tablename)
+    except dbpool.DatabaseError:
+        pass    #already there
+    rows, imported, unmatched = [], set(), []
+    for fundname, dates, returns in itertools.chain(*parsed):
+        if fundname in fundnums:
+            rows.extend(zip([fundnums[fundname]]*len(dates),dates,returns))
+            imported.add(fundnums[fundname])
+        else:
+            print fundname, 'not in fundnamecode'
+            unmatched.append(fundname)
+    c.executemany('DELETE FROM %s WHERE fundnum=?;' % tablename,[(fundnum,) for fundnum in imported])
+    for i in range(0,len(rows),batchsize):
+        c.executemany('INSERT INTO %s VALUES(?, ?, ?);' % tablename,rows[i:i+batchsize])
+    cnxn.commit()
+    cnxn.close()
+    return unmatched
 
 if __name__=='__main__':
-    importssdata(filenames=[FILENAME])
\ No newline at end of file
+    importssdata(filenames=[FILENAME])
@@ -1,13 +1,60 @@
 import csv
 import datetime
+import hashlib
+import itertools
+import numpy
 import scipy
 import pylab
-import pyodbc
+import dbpool
+import navcache
+import lrucache
 
-#This Login Info is being referenced as a static global name. Need to wrap a namespace so as to ascribe context
-PWD =  'pmanikonda_99'
-DBNAME = 'OracleDB' #DSN for ODBC
-ORACLESTRING = 'DSN=%s;PWD=%s' % (DBNAME, PWD) #oracle connection string
+PWD, DBNAME, ORACLESTRING = dbpool.PWD, dbpool.DBNAME, dbpool.ORACLESTRING #aliases of the dbpool defaults at import
+
+DATEUNIT = 'datetime64[us]' #resolution of the numpy date axes held by the streams
+FREQCACHE = lrucache.LRUCache(256) #resampled streams keyed by stream fingerprint and frequency, see ReturnStream.changefreq
+MARKETCHUNK = 50000 #rows of a market file parsed at a time, see parsemarketfile
+MARKETCOLUMNS = [('SPX','SPTR'),('RTY','RU20INTR'),('EAFE','GDDUEAFE'),('AGG','LBUSTRUU'),('TBILL','CASH')] #index name, price history column
+
+def dateaxis(dates):
+    """Converts a sorted list of datetimes into a numpy datetime64 array for binary searches (a datetime64 array isn't copied)."""
+    return numpy.asarray(dates, dtype=DATEUNIT)
+
+def quotereturns(quotes, flat=False):
+    """
+    Calculates the returns implied by a series of quotes in one vectorized pass.
+    
+    Parameters
+    ----------
+    quotes : 1-d array
+        quotes of the asset
+    flat : bool (default False)
+        if True, return a 1-d array,
+        otherwise a (n-1, 1) column.
+    
+    Note
+    ----
+    A return that starts from a zero quote is set to 0.
+    """
+    quotes = scipy.asarray(quotes, dtype=float).flatten()
+    previous, current = quotes[:-1], quotes[1:]
+    nonzero = previous!=0
+    returns = scipy.zeros(previous.size)
+    returns[nonzero] = current[nonzero]/previous[nonzero]-1.0
+    if flat:
+        return returns
+    return returns.reshape(returns.size,1)
+
+def clearfreqcache():
+    """Drops every resampled stream held in FREQCACHE."""
+    FREQCACHE.clear()
+
+def dateposition(dates):
+    """Builds a hash index from each date to the position of its first occurrence in dates."""
+    position = {}
+    for i in xrange(len(dates)-1, -1, -1):
+        position[dates[i]] = i
+    return position
 
 
 class ReturnStream:
@@ -27,12 +74,31 @@ class ReturnStream:
         self.enddates = enddates
         self.setdates = set(enddates)
         self.returns = returns
+        self.buildaxis()
+    
+    def buildaxis(self):
+        """
+        Builds the sorted numpy date axes and the hash index of the end dates.
+        Point lookups go through the hash index, slices are binary searches
+        on the axes.
+        """
+        self.startaxis = dateaxis(self.startdates)
+        self.endaxis = dateaxis(self.enddates)
+        self.endposition = dateposition(self.enddates)
     
     def std(self):
         """Returns standard deviation of returns."""
         return scipy.std(self.returns)
     
-    def changefreq(self, freq='W', dayofweek=2, forcedates=False):
+    def fingerprint(self):
+        """Returns a hash of the stream's dates and returns, used as a cache key."""
+        digest = hashlib.sha1()
+        digest.update(self.startaxis.tostring())
+        digest.update(self.endaxis.tostring())
+        digest.update(scipy.ascontiguousarray(self.returns).tostring())
+        return digest.hexdigest()
+    
+    def changefreq(self, freq='W', dayofweek=2, forcedates=False, cache=True):
         """
         Changes the frequency of returns.
         
@@ -47,30 +113,52 @@ class ReturnStream:
         forcedates : bool (default False)
             if True and weekly frequency is selected,
             then force a return on Wednesday.
+        cache : bool (default True)
+            if True, look up and store the result in FREQCACHE
+            so the same stream is only resampled once.
+        """
+        if cache:
+            key = (self.fingerprint(), freq, dayofweek, forcedates)
+            return FREQCACHE.get(key, lambda key : self.changefreq(freq, dayofweek, forcedates, cache=False))
+        mydates = self.resampledates(freq, dayofweek, forcedates)
+        if mydates is None:
+            return None
+        return self.datereturns(mydates)
+    
+    def resampledates(self, freq='W', dayofweek=2, forcedates=False):
         """
-        mydates = []
+        Picks the end dates for a change of frequency.
+        See changefreq for the parameters.
+        
+        Returns
+        -------
+        list of datetimes, or None if freq is not supported
+        or no end date falls on dayofweek when forcedates is True.
+        
+        Note
+        ----
+        When forcedates is True, the weeks are anchored on the first end date
+        that falls on dayofweek, and each anchor is moved back to the
+        latest available end date on or before it.
+        """
+        days = self.endaxis.astype('datetime64[D]').astype(numpy.int64)
         if freq=='W':
+            onday = scipy.flatnonzero((days+3)%7==dayofweek) #1970-01-01 was a Thursday
             if forcedates:
-                for enddate in self.enddates:
-                    if enddate.weekday()==dayofweek:
-                        while(enddate<self.enddates[-1]):
-                            origend = enddate
-                            while not(enddate in self.enddates):
-                                enddate = enddate - datetime.timedelta(days=1)
-                            mydates.append(enddate)
-                            enddate=origend+datetime.timedelta(days=7)
-                        return self.datereturns(mydates)
+                if onday.size==0:
+                    return None
+                first = onday[0]
+                weeks = (days[-1]-days[first]+6)//7 #number of anchors strictly before the last end date
+                anchors = self.endaxis[first]+scipy.arange(weeks)*numpy.timedelta64(7,'D')
+                positions = self.endaxis.searchsorted(anchors,side='right')-1
             else:
-                for enddate in self.enddates:
-                    if enddate.weekday()==dayofweek:
-                        mydates.append(enddate)
-                return self.datereturns(mydates)
+                positions = onday
         elif freq=='M':
-            for i in range(0,len(self.enddates)):
-                if (not(i==len(self.enddates)-1)) and (self.enddates[i].month!=self.enddates[i+1].month):
-                    mydates.append(self.enddates[i])
-            return self.datereturns(mydates)
-                
+            months = self.endaxis.astype('datetime64[M]').astype(numpy.int64)%12
+            positions = scipy.flatnonzero(months[:-1]!=months[1:])
+        else:
+            return None
+        return self.endaxis[positions].tolist()
     
     def __getitem__(self,index):
         """
@@ -89,53 +177,70 @@ class ReturnStream:
         otherwise returns a float.
         """
         if isinstance(index,slice):
-            startdate, enddate = index.start, index.stop
-            if startdate in self.startdates:
-                startindex = self.startdates.index(startdate)
-            elif startdate<self.startdates[0]:
-                startindex = self.startdates[0]
-            else:
-                while not(startdate in self.startdates):
-                    startdate = startdate + datetime.timedelta(days=1)
-                    if startdate>enddate:
-                        return None
-                startindex = self.startdates.index(startdate)
-            if enddate in self.enddates:
-                endindex = self.enddates.index(enddate)
-            elif enddate>self.enddates[-1]:
-                endindex = len(self.enddates)-1
-            else:
-                while not(enddate in self.enddates):
-                    if enddate<startdate:
-                        return None
-                    enddate = enddate - datetime.timedelta(days=1)
-                endindex = self.enddates.index(enddate)
+            bounds = self.sliceindices(index.start, index.stop)
+            if bounds is None:
+                return None
+            startindex, endindex = bounds
             return ReturnStream(self.startdates[startindex:endindex],self.enddates[startindex:endindex],
                                 self.returns[startindex:endindex])
         else:
-            if index in self.enddates: #may be a cleaner approach is to have a hash of dates and returns
-                return self.returns[self.enddates.index(index)] 
+            if index in self.endposition:
+                return self.returns[self.endposition[index]]
             else:
                 return None
 
+    def sliceindices(self, startdate, enddate):
+        """
+        Finds the positions used to slice the stream between two dates.
+        
+        Parameters
+        ----------
+        startdate : datetime
+            if it isn't a start date, the next start date is used
+        enddate : datetime
+            if it isn't an end date, the previous end date is used
+        
+        Returns
+        -------
+        (startindex, endindex) tuple for slicing the date lists and returns,
+        or None if there is no data between startdate and enddate.
+        """
+        if len(self.startdates)==0:
+            return None
+        startindex = self.startaxis.searchsorted(numpy.datetime64(startdate,'us'),side='left')
+        if startdate<self.startdates[0]:
+            startindex = 0
+        elif startindex==len(self.startdates):
+            return None
+        elif self.startdates[startindex]!=startdate:
+            if self.startdates[startindex]>enddate:
+                return None     #no start date between startdate and enddate
+            startdate = self.startdates[startindex]
+        if enddate>self.enddates[-1]:
+            endindex = len(self.enddates)-1
+        else:
+            endindex = self.endaxis.searchsorted(numpy.datetime64(enddate,'us'),side='right')-1
+            if endindex<0:
+                return None
+            #the day-by-day walk back from enddate gives up once it passes startdate
+            if self.enddates[endindex]!=enddate and self.enddates[endindex]+datetime.timedelta(days=1)<startdate:
+                return None
+        return startindex, endindex
+
     def datereturns(self, overlapdates):     # Return Stream method
         """Given a set of overlapdates, return a ReturnStream that includes just those dates.
         the idea is to find the overlapdates as a subset of the self.enddates and associate to startdate
-        how the accumulation rolls down"""
-        accumval = 1.0
-        returns = []
-        firststartdate = None
-        for dte in self.enddates:  #if this list is presorted then we can loop over the indices
-            dayreturn = self[dte]+1.0  #the [] operator has been overloaded in return stream class via __getitem__
-            if dte in overlapdates:
-                if not(firststartdate):
-                    firststartdate = self.startdates[self.enddates.index(dte)]
-                    accumval = 1.0
-                returns.append(accumval*dayreturn-1.0)
-                accumval = 1.0
-            else:  #roll down the investment with realized return
-                accumval *= dayreturn
-        return ReturnStream([firststartdate]+overlapdates[:-1], overlapdates, scipy.asarray(returns))
+        how the accumulation rolls down.
+        The overlapdates are located on the end date axis in one pass and the returns
+        in between are compounded with a segmented product (multiply.reduceat)."""
+        hits = scipy.flatnonzero(numpy.in1d(self.endaxis, dateaxis(overlapdates)))
+        if hits.size==0:
+            return ReturnStream([None]+overlapdates[:-1], overlapdates, scipy.asarray([]))
+        firststartdate = self.startaxis[hits[0]].tolist()
+        growth = 1.0+scipy.asarray(self.returns[:hits[-1]+1], dtype=float)
+        segmentstarts = scipy.concatenate(([hits[0]], hits[:-1]+1)) #returns before the first hit are dropped
+        returns = numpy.multiply.reduceat(growth, segmentstarts, axis=0)-1.0
+        return ReturnStream([firststartdate]+overlapdates[:-1], overlapdates, returns)
     
     def __add__(self,otherstream):
         """Add two streams' returns together and returns a new stream."""
@@ -167,33 +272,60 @@ class ReturnStream:
         pylab.show()
 
 class BasicStream(ReturnStream):             #BasicStream extends ReturnStream class
-    def __init__(self, dates, quotes):
+    DATEVIEWS = ['dates', 'startdates', 'enddates', 'setdates', 'quoteposition', 'endposition'] #see builddateviews
+    
+    def __init__(self, dates, quotes, flat=False):
         """
         Constructor for class to hold actual quotes,set of quote dates and returns implied by the quotes.
         dates,quotes are stored as lists and quotes are stored in scipy.ndarray
+        
+        If dates is a datetime64 array (e.g. memory-mapped by a navcache.NAVCache),
+        it is kept as the date axes, and the date lists, set and hash indexes
+        are only built when first used (see builddateviews).
+        
         Parameters
         ----------
-        dates : list of datetimes
+        dates : list of datetimes or datetime64 array
             dates of quotes
         quotes : 1-d array
             holds the quotes of the asset
+        flat : bool (default False)
+            if True, returns are stored as a 1-d array,
+            otherwise as a (n-1, 1) column.
         """
-        self.dates = dates
+        if isinstance(dates, numpy.ndarray):
+            self.quoteaxis = dateaxis(dates)
+            self.startaxis, self.endaxis = self.quoteaxis[:-1], self.quoteaxis[1:]
+        else:
+            self.dates = dates
+            self.startdates = self.dates[0:-1]
+            self.enddates = self.dates[1:]
+            self.setdates = set(self.enddates) #this is a set for later operations in return streams
+            self.quoteposition = dateposition(self.dates)
+            self.buildaxis()
+        self.quotes = quotes
+        self.returns = quotereturns(quotes, flat=flat)
+    
+    def builddateviews(self):
+        """Builds the date lists, set and hash indexes of a stream made from a datetime64 array."""
+        self.dates = self.quoteaxis.tolist()
         self.startdates = self.dates[0:-1]
         self.enddates = self.dates[1:]
-        self.setdates = set(self.enddates) #this is a set for later operations in return streams
-        self.quotes = quotes
-        lenreturns = len(quotes)
-        self.returns = scipy.zeros(shape=(lenreturns-1,1))  
-        #self.returns = self.quotes[1:]/self.quotes[0:-1]-1.0
-        for i in range(0,lenreturns-1):
-            self.returns[i] = (self.quotes[i+1]/float(self.quotes[i]))-1 if self.quotes[i] !=0 else 0
-           
+        self.setdates = set(self.enddates)
+        self.quoteposition = dateposition(self.dates)
+        self.endposition = dateposition(self.enddates)
+    
+    def __getattr__(self, name):
+        """Builds the date views on their first use, see builddateviews."""
+        if name in BasicStream.DATEVIEWS and 'quoteaxis' in self.__dict__:
+            self.builddateviews()
+            return self.__dict__[name]
+        raise AttributeError(name)
     
     def dayquote(self,key):
         """Returns the quote for a given done or a small number if that quote doesn't exist."""
-        if key in self.dates:
-            return self.quotes[self.dates.index(key)]
+        if key in self.quoteposition:
+            return self.quotes[self.quoteposition[key]]
         else:
             return 1E-7
         
@@ -209,63 +341,303 @@ def hybridstream(dates1,dates2,quotes1,quotes2):   #stand alone function
     quotes1, quotes2 : 1-d array
         quotes for both streams
     """
-    st1 = BasicStream(dates1,quotes1) #BASENAV
-    st2 = BasicStream(dates2,quotes2) #PNDY
-    #overlaplist = list(set([date for date in st1.enddates if date in st2.enddates]))
-    overlapdts = st1.overlap([st2])  #overlap method of returnstream class. Common dates of funds date info
-    ol1 = st1.datereturns(overlapdts)
-    ol2 = st2.datereturns(overlapdts)
-    returntest = (ol1.returns>=ol2.returns)
-    greatret = returntest*ol1.returns + (1-returntest)*ol2.returns # dysfunctional
-    return ReturnStream(ol1.startdates,ol1.enddates,greatret)
+    return hybridsources([(dates1,quotes1),(dates2,quotes2)],'max')[0]
+
+HYBRIDRULES = ['max','priority','median'] #ways hybridsources picks a return among the sources
+
+def hybridsources(sources, rule='max', maxabs=None):
+    """
+    Creates a new stream out of the returns of several NAV sources of one fund.
+    The sources are aligned on their common end dates in one pass: the return of
+    a source between two common dates compounds its daily returns in between with
+    a segmented product, as ReturnStream.datereturns does, and a daily return that
+    starts from a zero quote is 0 (see quotereturns).
+    
+    Parameters
+    ----------
+    sources : list of (dates, quotes) pairs
+        dates (list of datetimes or datetime64 array) and quotes (1-d array) of each source,
+        in priority order
+    rule : string (default 'max')
+        'max' takes the highest return, the earliest source on ties;
+        'priority' takes the return of the earliest source that has a valid one;
+        'median' takes the median of the valid returns (the lower one
+        for an even count)
+    maxabs : float (default None)
+        if given, returns larger than maxabs in absolute value are not valid;
+        nan and infinite returns never are
+    
+    Returns
+    -------
+    stream : ReturnStream
+        the picked returns, 0 on dates where no source had a valid return
+    winners : 1-d int array
+        position in sources of the source picked on each date, -1 if none
+    """
+    if not(rule in HYBRIDRULES):
+        raise ValueError('rule must be one of %s' % ', '.join(HYBRIDRULES))
+    axes = [dateaxis(dates[1:]) for dates, quotes in sources]
+    common = axes[0]
+    for axis in axes[1:]:
+        common = numpy.intersect1d(common, axis)
+    if common.size==0:
+        return ReturnStream([None], [], scipy.asarray([])), numpy.zeros(0, dtype=int)
+    returns = numpy.zeros((len(sources), common.size))
+    for i in range(0, len(sources)):
+        hits = axes[i].searchsorted(common) #positions of the common dates in the source's returns
+        growth = 1.0+quotereturns(sources[i][1], flat=True)[:hits[-1]+1]
+        segmentstarts = numpy.concatenate(([hits[0]], hits[:-1]+1)) #returns before the first hit are dropped
+        returns[i] = numpy.multiply.reduceat(growth, segmentstarts)-1.0
+    valid = numpy.isfinite(returns)
+    if maxabs is not None:
+        valid &= numpy.absolute(numpy.where(valid, returns, 0.0))<=maxabs
+    columns = numpy.arange(common.size)
+    if rule=='max':
+        winners = numpy.where(valid, returns, -numpy.inf).argmax(axis=0)
+    elif rule=='priority':
+        winners = valid.argmax(axis=0)
+    else:
+        order = numpy.where(valid, returns, numpy.inf).argsort(axis=0, kind='mergesort')
+        winners = order[(numpy.maximum(valid.sum(axis=0), 1)-1)//2, columns]
+    winners = numpy.where(valid.any(axis=0), winners, -1)
+    picked = numpy.where(winners>=0, returns[numpy.maximum(winners, 0), columns], 0.0)
+    enddates = common.tolist()
+    firstdates = dateaxis(sources[0][0])
+    startdates = [firstdates[axes[0].searchsorted(common[0])].tolist()]+enddates[:-1]
+    return ReturnStream(startdates, enddates, picked), winners
+
+
+class MarketPanel:
+    def __init__(self, mktbasket):
+        """
+        Constructor for class to hold a basket of market streams on one date axis.
+        It is built once per run and shared by every fund, so that aligning a fund
+        only costs a date intersection and a gather of rows.
+        
+        Parameters
+        ----------
+        mktbasket : dict
+            dictionary of market streams, at least one
+        
+        Note
+        ----
+        The panel behaves like the dictionary it was built from (keys, [] and len),
+        so it can be passed wherever a mktbasket is expected.
+        """
+        if not(mktbasket):
+            raise ValueError('MarketPanel needs at least one market stream')
+        self.basket = mktbasket
+        self.indexes = list(mktbasket.keys())
+        streamlist = [mktbasket[index] for index in self.indexes]
+        self.dates = streamlist[0].overlap(streamlist[1:])
+        self.axis = dateaxis(self.dates)
+        #rawreturns holds each index's own return on the panel dates,
+        #returns holds the returns compounded since the previous panel date
+        self.rawreturns = scipy.zeros((len(self.dates),len(self.indexes)))
+        self.returns = scipy.zeros((len(self.dates),len(self.indexes)))
+        for i in range(0,len(streamlist)):
+            positions = streamlist[i].endaxis.searchsorted(self.axis)
+            self.rawreturns[:,i] = scipy.asarray(streamlist[i].returns,dtype=float).flatten()[positions]
+            if len(self.dates)>0:
+                self.returns[:,i] = streamlist[i].datereturns(self.dates).returns.flatten()
+    
+    def keys(self):
+        """Returns the index names in the column order of the panel."""
+        return list(self.indexes)
+    
+    def __getitem__(self, index):
+        """Returns the market stream for an index name."""
+        return self.basket[index]
+    
+    def __len__(self):
+        return len(self.indexes)
+    
+    def window(self, startdate, enddate):
+        """
+        Finds the panel positions that fall inside every index's slice
+        between startdate and enddate (see ReturnStream.__getitem__).
+        
+        Returns
+        -------
+        (first, last) positions on the panel axis, last excluded,
+        or None if an index has no data in the window.
+        """
+        lowdate, highdate = None, None
+        for index in self.indexes:
+            stream = self.basket[index]
+            bounds = stream.sliceindices(startdate, enddate)
+            if bounds is None or bounds[1]<=bounds[0]:
+                return None
+            low, high = stream.endaxis[bounds[0]], stream.endaxis[bounds[1]-1]
+            lowdate = low if lowdate is None else max(lowdate, low)
+            highdate = high if highdate is None else min(highdate, high)
+        first = self.axis.searchsorted(lowdate,side='left')
+        last = self.axis.searchsorted(highdate,side='right')
+        return first, last
+    
+    def align(self, stream, startdate, enddate):
+        """
+        Aligns a stream with the panel between two dates.
+        Gives the same results as aligning against every market stream separately.
+        
+        Parameters
+        ----------
+        stream : ReturnStream
+            stream to align, e.g. the fund's stream
+        startdate : datetime
+            beginning of alignment period
+        enddate : datetime
+            end of alignment period
         
+        Returns
+        -------
+        getdates : list of datetimes
+            the aligned dates, or None if there are fewer than 3 of them
+        streamreturns : 1-d array
+            the stream's returns on getdates
+        indexreturns : 2-d array
+            the index returns on getdates, one column per index
+        """
+        hits, getdates = self.aligndates(stream, startdate, enddate)
+        if hits is None:
+            return None, None, None
+        streamreturns = stream.datereturns(getdates).returns.flatten()
+        return getdates, streamreturns, self.rows(hits)
+    
+    def aligndates(self, stream, startdate, enddate):
+        """
+        Finds the panel dates shared with a stream between two dates.
+        
+        Returns
+        -------
+        hits : 1-d array
+            positions of the aligned dates on the panel axis,
+            or None if there are fewer than 3 of them
+        getdates : list of datetimes
+            the aligned dates
+        """
+        bounds = self.window(startdate, enddate)
+        if bounds is None:
+            return None, None
+        first, last = bounds
+        hits = first+scipy.flatnonzero(numpy.in1d(self.axis[first:last], stream.endaxis))
+        if hits.size<3:
+            return None, None
+        return hits, [self.dates[i] for i in hits]
+    
+    def subwindow(self, hits, startdate, enddate):
+        """
+        Finds which aligned positions (see aligndates) fall in the window
+        between startdate and enddate.
+        
+        Returns
+        -------
+        slice of hits
+        """
+        bounds = self.window(startdate, enddate)
+        if bounds is None:
+            return slice(0,0)
+        return slice(hits.searchsorted(bounds[0]),hits.searchsorted(bounds[1]))
+    
+    def rows(self, hits):
+        """
+        Gathers the index returns on the aligned panel positions (see aligndates).
+        The first row isn't compounded, the rest compound back to the previous position.
+        
+        Returns
+        -------
+        2-d array with one row per position and one column per index
+        """
+        rolled = numpy.multiply.reduceat(1.0+self.returns[hits[0]+1:hits[-1]+1], hits[:-1]-hits[0], axis=0)-1.0
+        return scipy.vstack([self.rawreturns[hits[0]], rolled])
 
-def getmarketdatadb(connectstring=ORACLESTRING, DBName = 'ODSACT.ACT_RSL_EQTY_PRICE_HIST',
-                    ValuationDateField = 'VALUATION_DT'):
+def getmarketdatadb(connectstring=None, DBName = 'ODSACT.ACT_RSL_EQTY_PRICE_HIST',
+                    ValuationDateField = 'VALUATION_DT', cache=None, columns=MARKETCOLUMNS, arraysize=10000):
     """Grabs the available market data out of the database,
-    and puts it into a dictionary of return streams. In case of null values for the field values,they are replaced by 0"""
-    cnxn = pyodbc.connect(connectstring)
+    and puts it into a dictionary of return streams. In case of null values for the field values,they are replaced by 0.
+    If a navcache.NAVCache is given, the quotes are read from it when it holds every index,
+    and stored in it after a database load otherwise.
+    columns lists the (index name, column) pairs to load, MARKETCOLUMNS by default;
+    the rows are fetched arraysize at a time straight into numpy columns."""
+    names = [name for name, column in columns]
+    if cache and all([cache.valid(navcache.marketkey(name)) for name in names]):
+        mktbasket = {}
+        for name in names:
+            dates, quotes = cache.get(navcache.marketkey(name))
+            mktbasket[name] = BasicStream(dates,quotes,flat=True)
+        return mktbasket
+    cnxn = dbpool.connect(connectstring)
     c = cnxn.cursor()
-    sql = 'SELECT * FROM %s ORDER BY %s;' % (DBName,ValuationDateField)
-#     sql = 'SELECT * FROM ODSACT.ACT_RSL_EQTY_PRICE_HIST ORDER BY VALUATION_DT;'
+    sql = 'SELECT %s, %s FROM %s ORDER BY %s;' % (ValuationDateField,', '.join([column for name, column in columns]),
+                                                 DBName,ValuationDateField)
+    c.arraysize = arraysize
     c.execute(sql)  #sql
-    dates, spx, rty, eafe, agg, tbill = [],[],[],[],[],[]
-    rows = c.fetchmany(100)
+    size, capacity = 0, arraysize
+    valuationaxis, quotes = numpy.zeros(capacity, dtype=DATEUNIT), numpy.zeros((capacity, len(columns)))
+    rows = c.fetchmany(arraysize)
     while rows:
-        for row in rows:                                          # for row in c.fetchall()
-            dates.append(row.VALUATION_DT)  if row.VALUATION_DT is not None else dates.append(datetime.datetime(1900,1,1))
-            if row.VALUATION_DT is None:
-                print 'ValuationDate is NULL.Set to Jan-1-1900'
-            spx.append(float(row.SPTR))     if row.SPTR         is not None else spx.append(0.0)
-            rty.append(float(row.RU20INTR)) if row.RU20INTR     is not None else rty.append(0.0) 
-            eafe.append(float(row.GDDUEAFE))if row.GDDUEAFE     is not None else eafe.append(0.0)
-            agg.append(float(row.LBUSTRUU)) if row.LBUSTRUU     is not None else agg.append(0.0)
-            tbill.append(float(row.CASH))   if row.CASH         is not None else tbill.append(0.0)
-        rows = c.fetchmany(100)
-    return {  'SPX'     : BasicStream(dates,scipy.asarray(spx)),
-              'RTY'     : BasicStream(dates,scipy.asarray(rty)),
-              'EAFE'    : BasicStream(dates,scipy.asarray(eafe)),
-              'AGG'     : BasicStream(dates,scipy.asarray(agg)),
-              'TBILL'   : BasicStream(dates,scipy.asarray(tbill))}
+        if size+len(rows)>capacity:
+            capacity = max(2*capacity, size+len(rows))
+            valuationaxis.resize(capacity, refcheck=False)
+            quotes.resize((capacity, len(columns)), refcheck=False)
+        block = numpy.array([tuple(row) for row in rows], dtype=object).reshape(len(rows), len(columns)+1)
+        nulls = numpy.equal(block, None)
+        if nulls[:,0].any():
+            print '%d ValuationDates are NULL.Set to Jan-1-1900' % nulls[:,0].sum()
+        block[nulls] = 0.0
+        block[nulls[:,0],0] = datetime.datetime(1900,1,1)
+        valuationaxis[size:size+len(rows)] = block[:,0].astype(DATEUNIT)
+        quotes[size:size+len(rows)] = block[:,1:].astype(float)
+        size += len(rows)
+        rows = c.fetchmany(arraysize)
+    cnxn.close()
+    dates = valuationaxis[:size].tolist()
+    mktbasket = {}
+    for i in range(0, len(names)):
+        mktbasket[names[i]] = BasicStream(dates, quotes[:size,i].copy(), flat=True)
+    if cache:
+        for name in names:
+            cache.put(navcache.marketkey(name),dates,mktbasket[name].quotes)
+        cache.flush()
+    return mktbasket
+
+def integerdates(values):
+    """Converts an array of YYYYMMDD integers into datetime64 dates."""
+    years, months, days = values//10000, values//100%100, values%100
+    dates = (years-1970).astype('datetime64[Y]').astype('datetime64[M]')+(months-1)
+    dates = dates.astype('datetime64[D]')+(days-1)
+    if numpy.any((months<1) | (months>12) | (days<1) | (dates.astype('datetime64[M]')!=(dates-(days-1)).astype('datetime64[M]'))):
+        raise ValueError('invalid YYYYMMDD date in market file')
+    return dates.astype(DATEUNIT)
 
-def parsemarketfile(filename):
-    """Parses market data out of a file into a dictionary of streams."""
+def parsemarketfile(filename, chunksize=MARKETCHUNK):
+    """
+    Parses market data out of a file into a dictionary of streams.
+    The file holds a date column and a quote column per index, with the index
+    names in the header over the quote columns; the columns may end at different rows.
+    Rows are read chunksize at a time into numpy string blocks, and the dates are
+    decoded from their YYYYMMDD digits as integers.
+    """
     f = open(filename)
     csvparser = csv.reader(f)
-    names,dates,quotes, streambasket = [], {}, {}, {}
-    for row in csvparser:
-        if len(names)==0:
-            indexcount = len(row)/2
-            for i in range(0,indexcount):
-                indexname = row[2*i+1]
-                names.append(indexname)
-                dates[indexname] = []
-                quotes[indexname] = []
-        else:
-            for i in range(0,indexcount):
-                if row[2*i]:
-                    dates[names[i]].append(datetime.datetime.strptime(row[2*i],'%Y%m%d'))
-                    quotes[names[i]].append(float(row[2*i+1]))
-    for index in names:
-        streambasket[index] = BasicStream(dates[index],scipy.asarray(quotes[index]))
+    header = next(csvparser, [])
+    indexcount = len(header)/2
+    names = [header[2*i+1] for i in range(0,indexcount)]
+    dates, quotes, streambasket = [[] for name in names], [[] for name in names], {}
+    width = 2*indexcount
+    while indexcount:
+        rows = list(itertools.islice(csvparser,chunksize))
+        if not(rows):
+            break
+        block = numpy.array([row[:width]+['']*(width-len(row)) for row in rows])
+        for i in range(0,indexcount):
+            present = block[:,2*i]!=''
+            if present.any():
+                dates[i].append(integerdates(block[present,2*i].astype(numpy.int64)))
+                quotes[i].append(block[present,2*i+1].astype(float))
+    f.close()
+    for i in range(0,indexcount):
+        indexdates = numpy.concatenate(dates[i]) if dates[i] else numpy.zeros(0,dtype=DATEUNIT)
+        indexquotes = numpy.concatenate(quotes[i]) if quotes[i] else numpy.zeros(0)
+        streambasket[names[i]] = BasicStream(indexdates.tolist(),indexquotes,flat=True)
     return streambasket
\ No newline at end of file